@@ -0,0 +1,329 @@
+import threading
+import time
+
+from kazoo.exceptions import (BadVersionError, NoNodeError, NodeExistsError, NotEmptyError, RolledBackError,
+                              RuntimeInconsistency)
+from kazoo.protocol.states import EventType, KazooState, WatchedEvent, ZnodeStat
+
+
+class FakeNode:
+    __slots__ = ('data', 'czxid', 'mzxid', 'pzxid', 'version', 'cversion', 'children')
+
+    def __init__(self, data, zxid):
+        self.data = data
+        self.czxid = zxid
+        self.mzxid = zxid
+        self.pzxid = zxid
+        self.version = 0
+        self.cversion = 0
+        self.children = {}
+
+    def stat(self):
+        return ZnodeStat(self.czxid, self.mzxid, 0, 0, self.version, self.cversion, 0, 0,
+                         len(self.data), len(self.children), self.pzxid)
+
+
+class FakeAsyncResult:
+
+    """Result of an asynchronous call, available `latency` seconds after it was issued.
+
+    The call itself is applied immediately, so many requests issued together
+    wait for their latency concurrently, like pipelined requests do.
+    """
+
+    def __init__(self, call, ready_at):
+        self.ready_at = ready_at
+        try:
+            self.value = call()
+            self.exception = None
+        except Exception as e:
+            self.value = None
+            self.exception = e
+
+    def rawlink(self, callback):
+        """Calls `callback` with this result once it is available, from another thread, like kazoo does."""
+        timer = threading.Timer(max(0.0, self.ready_at - time.monotonic()), callback, (self,))
+        timer.daemon = True
+        timer.start()
+
+    def successful(self):
+        return self.exception is None
+
+    def get(self, block=True, timeout=None):
+        delay = self.ready_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if self.exception:
+            raise self.exception
+        return self.value
+
+
+class FakeKazooClient:
+
+    """In-memory stand-in for KazooClient with injectable per-call latency.
+
+    Supports the calls the scripts make: children, get, set, exists, create,
+    delete (also recursive), multi transactions and their *_async variants,
+    with one-shot data and children watches. Every request sent to the
+    "server" counts as one round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.root = FakeNode(b"", 0)
+        self.zxid = 0
+        self.latency = latency
+        self.round_trips = 0
+        self.lock = threading.RLock()
+        self.connected = True
+        self.listeners = []
+        self.data_watches = {}
+        self.child_watches = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+    def reset_round_trips(self):
+        self.round_trips = 0
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def expire_session(self):
+        """Drops all watches and notifies listeners the way kazoo does when the session expires."""
+        self.data_watches = {}
+        self.child_watches = {}
+        for listener in self.listeners:
+            listener(KazooState.LOST)
+        for listener in self.listeners:
+            listener(KazooState.CONNECTED)
+
+    def add_watch(self, watches, path, watch):
+        if watch is not None:
+            watches.setdefault(path, set()).add(watch)
+
+    def trigger(self, watches, path, event_type):
+        for watch in watches.pop(path, ()):
+            watch(WatchedEvent(event_type, KazooState.CONNECTED, path))
+
+    def node(self, path):
+        node = self.root
+        for name in path.split('/'):
+            if name:
+                node = node.children.get(name)
+                if node is None:
+                    raise NoNodeError(path)
+        return node
+
+    def split(self, path):
+        parent, _, name = path.rstrip('/').rpartition('/')
+        return parent or '/', name
+
+    def next_zxid(self):
+        self.zxid += 1
+        return self.zxid
+
+    def do_create(self, path, value=b"", makepath=False):
+        parent_path, name = self.split(path)
+        try:
+            parent = self.node(parent_path)
+        except NoNodeError:
+            if not makepath:
+                raise
+            self.do_create(parent_path, b"", True)
+            parent = self.node(parent_path)
+        if name in parent.children:
+            raise NodeExistsError(path)
+        zxid = self.next_zxid()
+        parent.children[name] = FakeNode(value, zxid)
+        parent.cversion += 1
+        parent.pzxid = zxid
+        self.trigger(self.data_watches, path, EventType.CREATED)
+        self.trigger(self.child_watches, parent_path, EventType.CHILD)
+        return path
+
+    def do_delete(self, path, version=-1):
+        parent_path, name = self.split(path)
+        node = self.node(path)
+        if version != -1 and version != node.version:
+            raise BadVersionError(path)
+        if node.children:
+            raise NotEmptyError(path)
+        parent = self.node(parent_path)
+        del parent.children[name]
+        parent.cversion += 1
+        parent.pzxid = self.next_zxid()
+        self.trigger(self.data_watches, path, EventType.DELETED)
+        self.trigger(self.child_watches, path, EventType.DELETED)
+        self.trigger(self.child_watches, parent_path, EventType.CHILD)
+        return True
+
+    def do_set(self, path, value, version=-1):
+        if not isinstance(value, bytes):
+            raise TypeError("Invalid type for 'value' (must be a byte string)")
+        node = self.node(path)
+        if version != -1 and version != node.version:
+            raise BadVersionError(path)
+        node.data = value
+        node.version += 1
+        node.mzxid = self.next_zxid()
+        self.trigger(self.data_watches, path, EventType.CHANGED)
+        return node.stat()
+
+    def do_get(self, path, watch=None):
+        node = self.node(path)
+        self.add_watch(self.data_watches, path, watch)
+        return node.data, node.stat()
+
+    def do_get_children(self, path, include_data=False, watch=None):
+        node = self.node(path)
+        self.add_watch(self.child_watches, path, watch)
+        if include_data:
+            return list(node.children), node.stat()
+        return list(node.children)
+
+    def do_exists(self, path, watch=None):
+        # like in ZooKeeper, the watch is set also when the node does not exist
+        self.add_watch(self.data_watches, path, watch)
+        try:
+            return self.node(path).stat()
+        except NoNodeError:
+            return None
+
+    def call(self, operation, *args):
+        with self.lock:
+            self.round_trips += 1
+            if self.latency:
+                time.sleep(self.latency)
+            return operation(*args)
+
+    def call_async(self, operation, *args):
+        with self.lock:
+            self.round_trips += 1
+            return FakeAsyncResult(lambda: operation(*args), time.monotonic() + self.latency)
+
+    def ensure_path(self, path):
+        if self.do_exists(path) is None:
+            self.do_create(path, b"", True)
+        return True
+
+    def create(self, path, value=b"", makepath=False):
+        return self.call(self.do_create, path, value, makepath)
+
+    def get(self, path, watch=None):
+        return self.call(self.do_get, path, watch)
+
+    def get_children(self, path, watch=None, include_data=False):
+        return self.call(self.do_get_children, path, include_data, watch)
+
+    def exists(self, path, watch=None):
+        return self.call(self.do_exists, path, watch)
+
+    def set(self, path, value, version=-1):
+        return self.call(self.do_set, path, value, version)
+
+    def delete(self, path, version=-1, recursive=False):
+        if recursive:
+            # same request pattern as kazoo: list, recurse, delete
+            try:
+                children = self.get_children(path)
+            except NoNodeError:
+                return True
+            for child in children:
+                self.delete("{}/{}".format(path, child), recursive=True)
+        try:
+            return self.call(self.do_delete, path, version)
+        except NoNodeError:
+            if recursive:
+                return True
+            raise
+
+    def get_async(self, path, watch=None):
+        return self.call_async(self.do_get, path, watch)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return self.call_async(self.do_get_children, path, include_data, watch)
+
+    def exists_async(self, path, watch=None):
+        return self.call_async(self.do_exists, path, watch)
+
+    def set_async(self, path, value, version=-1):
+        return self.call_async(self.do_set, path, value, version)
+
+    def delete_async(self, path, version=-1):
+        return self.call_async(self.do_delete, path, version)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+
+class FakeTransaction:
+
+    """Multi transaction: either every operation is applied or none, results follow kazoo's conventions."""
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.committed = False
+
+    def create(self, path, value=b"", acl=None, ephemeral=False, sequence=False):
+        self.operations.append(('create', path, value))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', path, version))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set', path, value, version))
+
+    def check(self, path, version):
+        self.operations.append(('check', path, version))
+
+    def apply(self):
+        client = self.client
+        undo = []
+        results = []
+        for i, operation in enumerate(self.operations):
+            kind, path = operation[0], operation[1]
+            try:
+                if kind == 'create':
+                    results.append(client.do_create(path, operation[2]))
+                    undo.append(lambda path=path: client.do_delete(path))
+                elif kind == 'delete':
+                    parent_path, name = client.split(path)
+                    node = client.node(path)
+                    results.append(client.do_delete(path, operation[2]))
+                    undo.append(lambda parent_path=parent_path, name=name, node=node:
+                                client.node(parent_path).children.__setitem__(name, node))
+                elif kind == 'set':
+                    node = client.node(path)
+                    previous = (node.data, node.version, node.mzxid)
+                    results.append(client.do_set(path, operation[2], operation[3]))
+                    undo.append(lambda node=node, previous=previous: restore(node, *previous))
+                else:
+                    if client.node(path).version != operation[2]:
+                        raise BadVersionError(path)
+                    results.append(True)
+            except Exception as e:
+                for step in reversed(undo):
+                    step()
+                return ([RolledBackError() for _ in range(i)] + [e]
+                        + [RuntimeInconsistency() for _ in self.operations[i + 1:]])
+        return results
+
+    def commit_async(self):
+        self.committed = True
+        return self.client.call_async(self.apply)
+
+    def commit(self):
+        return self.commit_async().get()
+
+
+def restore(node, data, version, mzxid):
+    node.data = data
+    node.version = version
+    node.mzxid = mzxid
@@ -0,0 +1,200 @@
+import contextlib
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_zookeeper import FakeKazooClient  # noqa: E402
+from synthetic import HermesLayout  # noqa: E402
+
+from hermes_tools.consumer_state import ConsumerCleanupState  # noqa: E402
+from hermes_tools.deletion import SubtreeDeleter  # noqa: E402
+from hermes_tools.instrumentation import InstrumentedZooKeeper, Metrics  # noqa: E402
+from hermes_tools.ownership import iter_csv_configuration, load_csv_configuration  # noqa: E402
+from hermes_tools.throttling import AdaptiveThrottle, TokenBucket  # noqa: E402
+from hermes_tools.writes import BatchWriter  # noqa: E402
+
+PREFIX = '/run/hermes'
+
+
+def load_script(filename):
+    name = os.path.splitext(filename)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+traverser = load_script('hermes-traverser.py')
+cleaner = load_script('hermes-maxrate-tree-cleaner.py')
+owner_migrator = load_script('hermes-owner-migrator.py')
+
+
+def bench_traverse(zk, layout, options):
+    writer = BatchWriter(zk, options['batch_size'])
+
+    def run():
+        traverser.traverse(zk, writer, PREFIX, False, options['concurrency'])
+        writer.flush()
+    return run
+
+
+def bench_active_subscriptions(zk, layout, options):
+    return lambda: cleaner.get_all_active_subscriptions(zk, PREFIX, options['concurrency'])
+
+
+def bench_maxrate_consumers(zk, layout, options):
+    consumers = cleaner.get_consumers(zk, PREFIX)
+    max_rate_subscriptions = cleaner.get_all_maxrate_subscriptions(zk, PREFIX)
+    deleter = SubtreeDeleter(zk, TokenBucket(float('inf')), concurrency=options['concurrency'])
+    return lambda: cleaner.cleanup_maxrate_consumers(
+        consumers, max_rate_subscriptions, zk, PREFIX, True, deleter, concurrency=options['concurrency']
+    )
+
+
+def bench_maxrate_consumers_incremental(zk, layout, options):
+    """Next run of the cleanup with --state, after 1% of max-rate subscriptions got a consumer that is gone since."""
+    state = ConsumerCleanupState(os.path.join(os.path.dirname(options['owners']), 'state.json'), PREFIX)
+    deleter = SubtreeDeleter(zk, TokenBucket(float('inf')), concurrency=options['concurrency'])
+
+    def run():
+        registry = {}
+        consumers = cleaner.get_consumers(zk, PREFIX, registry)
+        max_rate_subscriptions = cleaner.get_all_maxrate_subscriptions(zk, PREFIX)
+        cleaner.cleanup_maxrate_consumers(consumers, max_rate_subscriptions, zk, PREFIX, True, deleter,
+                                          concurrency=options['concurrency'], state=state, registry=registry)
+        return max_rate_subscriptions
+
+    # the first run cleans the tree up, the second one finds it clean
+    run()
+    for subscription in list(run())[::100]:
+        zk.do_create("{}/consumers-rate/runtime/{}/dc1-gone-since".format(PREFIX, subscription), b"")
+    return run
+
+
+def bench_adaptive_removal(zk, layout, options, instrumented=False):
+    """Removes 200 max-rate subscription subtrees with --adaptive from 4 ops/s, which a healthy ensemble lets reach the maximum.
+
+    `instrumented` goes through InstrumentedZooKeeper, as the cleaner does with --progress or --metrics-out.
+    """
+    roots = ["{}/consumers-rate/runtime/{}".format(PREFIX, subscription)
+             for subscription in sorted(zk.get_children("{}/consumers-rate/runtime".format(PREFIX)))[:200]]
+    metrics = Metrics('benchmark') if instrumented else None
+    if instrumented:
+        zk = InstrumentedZooKeeper(zk, metrics)
+    throttle = AdaptiveThrottle(zk, 4.0, min_rate=0.5, max_rate=50.0, target_latency=0.1)
+    deleter = SubtreeDeleter(zk, throttle, parallel=4, concurrency=options['concurrency'])
+
+    def run():
+        deleter.delete(roots)
+        if throttle.rate < throttle.max_rate:
+            raise click.ClickException("--adaptive stayed at {:.1f} ops/s, below the maximum of {:.1f}".format(
+                throttle.rate, throttle.max_rate
+            ))
+        if instrumented and ('zookeeper', 'multi') not in metrics.operations:
+            raise click.ClickException("Removals weren't recorded in metrics")
+    return run
+
+
+def bench_owner_migrator(zk, layout, options):
+    writer = BatchWriter(zk, options['batch_size'])
+
+    def run():
+        data = load_csv_configuration(options['owners'])
+        owner_migrator.traverse(zk, writer, PREFIX, data, False, options['concurrency'])
+        writer.flush()
+    return run
+
+
+def bench_owner_migrator_direct(zk, layout, options):
+    writer = BatchWriter(zk, options['batch_size'])
+
+    def run():
+        chunks = iter_csv_configuration(options['owners'], 10000)
+        owner_migrator.traverse_direct(zk, writer, PREFIX, chunks, False, options['concurrency'])
+        writer.flush()
+    return run
+
+
+BENCHMARKS = {
+    'traverse': bench_traverse,
+    'active-subscriptions': bench_active_subscriptions,
+    'maxrate-consumers': bench_maxrate_consumers,
+    'maxrate-consumers-incremental': bench_maxrate_consumers_incremental,
+    'adaptive-removal': bench_adaptive_removal,
+    'adaptive-removal-instrumented': partial(bench_adaptive_removal, instrumented=True),
+    'owner-migrator': bench_owner_migrator,
+    'owner-migrator-direct': bench_owner_migrator_direct,
+}
+
+
+def measure(name, size, options):
+    """Runs one benchmark on a fresh tree, setup is excluded from all measurements."""
+    zk = FakeKazooClient()
+    layout = HermesLayout(size, PREFIX)
+    layout.populate(zk)
+    with tempfile.TemporaryDirectory() as directory:
+        options = dict(options, owners=os.path.join(directory, 'owners.csv'))
+        layout.write_owners_csv(options['owners'])
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run = BENCHMARKS[name](zk, layout, options)
+            zk.latency = options['latency']
+            zk.reset_round_trips()
+            if options['memory']:
+                tracemalloc.start()
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if options['memory'] else None
+            tracemalloc.stop()
+
+    return {
+        'benchmark': name,
+        'subscriptions': size,
+        'seconds': round(elapsed, 3),
+        'round_trips': zk.round_trips,
+        'peak_mb': round(peak / 2 ** 20, 1) if peak is not None else None,
+    }
+
+
+@click.command()
+@click.option('--sizes', default='1000,10000,100000', help='comma separated numbers of subscriptions in the synthetic tree')
+@click.option('--benchmark', '-b', 'names', multiple=True, type=click.Choice(list(BENCHMARKS)), help='benchmark to run, all by default')
+@click.option('--latency', default=1.0, type=click.FloatRange(min=0), help='simulated zookeeper round trip time in ms')
+@click.option('--concurrency', '-c', default=1, type=click.IntRange(min=1), help='value of the scripts --concurrency option')
+@click.option('--batch-size', default=50, type=click.IntRange(min=1), help='value of the scripts --batch-size option')
+@click.option('--memory/--no-memory', default=True, help='trace peak memory, makes the run slower')
+@click.option('--output', '-o', help='also write results to this JSON file')
+def run_benchmarks(sizes, names, latency, concurrency, batch_size, memory, output):
+
+    """Measures Hermes scripts against an in-memory ZooKeeper with synthetic trees"""
+
+    options = {'latency': latency / 1000.0, 'concurrency': concurrency, 'batch_size': batch_size, 'memory': memory}
+    results = []
+    click.echo("{:<32}{:>14}{:>12}{:>14}{:>12}".format('benchmark', 'subscriptions', 'seconds', 'round trips', 'peak MB'))
+    for size in [int(s) for s in sizes.split(',')]:
+        for name in names or BENCHMARKS:
+            result = measure(name, size, options)
+            results.append(result)
+            click.echo("{benchmark:<32}{subscriptions:>14}{seconds:>12.3f}{round_trips:>14}{peak:>12}".format(
+                peak='-' if result['peak_mb'] is None else result['peak_mb'], **result
+            ))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    run_benchmarks()
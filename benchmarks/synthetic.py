@@ -0,0 +1,143 @@
+import csv
+import json
+import random
+
+SUBSCRIPTIONS_PER_TOPIC = 4
+TOPICS_PER_GROUP = 10
+CONSUMERS_PER_CLUSTER = 20
+CLUSTERS = ('dc1', 'dc2')
+
+
+def topic_payload(group, topic, owner):
+    return {
+        'name': "{}.{}".format(group, topic),
+        'description': "Events published by {} about {}".format(group, topic),
+        'owner': owner,
+        'retentionTime': {'duration': 1, 'retentionUnit': 'DAYS'},
+        'jsonToAvroDryRunEnabled': False,
+        'ack': 'LEADER',
+        'trackingEnabled': False,
+        'migratedFromJsonType': False,
+        'schemaIdAwareSerializationEnabled': False,
+        'contentType': 'AVRO',
+        'maxMessageSize': 10240,
+        'auth': {'publishers': [], 'enabled': False, 'unauthenticatedAccessEnabled': True},
+        'subscribingRestricted': False,
+        'offlineStorage': {'enabled': False, 'retentionTime': {'duration': 60, 'infinite': False}},
+        'labels': [],
+        'createdAt': 1590000000.0,
+        'modifiedAt': 1590000000.0,
+    }
+
+
+def subscription_payload(group, topic, name, owner, state, support_team):
+    payload = {
+        'topicName': "{}.{}".format(group, topic),
+        'name': name,
+        'endpoint': "http://{}.{}.example.com/events/{}".format(name, group, topic),
+        'state': state,
+        'description': "Delivers {} events to {}".format(topic, name),
+        'subscriptionPolicy': {
+            'rate': 400, 'messageTtl': 3600, 'messageBackoff': 100, 'requestTimeout': 1000,
+            'socketTimeout': 0, 'sendingDelay': 0, 'backoffMultiplier': 1.0, 'backoffMaxIntervalInSec': 600,
+            'retryClientErrors': False, 'inflightSize': None,
+        },
+        'trackingEnabled': False,
+        'trackingMode': 'trackingOff',
+        'owner': owner,
+        'monitoringDetails': {'severity': 'NON_IMPORTANT', 'reaction': ''},
+        'contentType': 'JSON',
+        'deliveryType': 'SERIAL',
+        'filters': [],
+        'mode': 'ANYCAST',
+        'headers': [{'name': 'X-Source', 'value': 'hermes'}],
+        'endpointAddressResolverMetadata': {},
+        'oAuthPolicy': None,
+        'http2Enabled': False,
+        'subscriptionIdentityHeadersEnabled': False,
+        'autoDeleteWithTopicEnabled': False,
+        'createdAt': 1590000000.0,
+        'modifiedAt': 1590000000.0,
+    }
+    if support_team:
+        payload['supportTeam'] = support_team
+    return payload
+
+
+class HermesLayout:
+
+    """Synthetic Hermes tree of `subscriptions` subscriptions, deterministic for a given seed.
+
+    Roughly 70% of subscriptions are active, 20% lack supportTeam, and the
+    max-rate tree contains nodes of removed subscriptions and of consumers
+    that are no longer registered, so every script finds some work to do.
+    """
+
+    def __init__(self, subscriptions, prefix='/run/hermes', seed=1):
+        self.prefix = prefix
+        self.random = random.Random(seed)
+        topics = max(1, subscriptions // SUBSCRIPTIONS_PER_TOPIC)
+        self.groups = ["pl.allegro.group{}".format(g) for g in range((topics + TOPICS_PER_GROUP - 1) // TOPICS_PER_GROUP)]
+        self.topics = [(self.groups[t // TOPICS_PER_GROUP], "topic{}".format(t)) for t in range(topics)]
+        self.subscriptions = [
+            (group, topic, "subscription{}".format(s))
+            for group, topic in self.topics
+            for s in range(SUBSCRIPTIONS_PER_TOPIC)
+        ][:subscriptions]
+        self.consumers = {
+            cluster: ["{}-consumer{}".format(cluster, c) for c in range(CONSUMERS_PER_CLUSTER)] for cluster in CLUSTERS
+        }
+
+    def owner(self):
+        return {'source': 'Service Catalog', 'id': str(self.random.randint(1, 500))}
+
+    def populate(self, zk):
+        """Creates the tree directly, without counting round trips."""
+        create = zk.do_create
+        prefix = self.prefix
+        zk.ensure_path("{}/groups".format(prefix))
+        for group in self.groups:
+            create("{}/groups/{}".format(prefix, group), json.dumps({'groupName': group}).encode("utf-8"))
+            create("{}/groups/{}/topics".format(prefix, group))
+        for group, topic in self.topics:
+            path = "{}/groups/{}/topics/{}".format(prefix, group, topic)
+            create(path, json.dumps(topic_payload(group, topic, self.owner())).encode("utf-8"))
+            create("{}/subscriptions".format(path))
+
+        active = []
+        for group, topic, name in self.subscriptions:
+            state = 'ACTIVE' if self.random.random() < 0.7 else self.random.choice(['SUSPENDED', 'PENDING'])
+            support_team = None if self.random.random() < 0.2 else 'team{}'.format(self.random.randint(1, 50))
+            payload = subscription_payload(group, topic, name, self.owner(), state, support_team)
+            create("{}/groups/{}/topics/{}/subscriptions/{}".format(prefix, group, topic, name),
+                   json.dumps(payload).encode("utf-8"))
+            if state == 'ACTIVE':
+                active.append("{}.{}${}".format(group, topic, name))
+
+        registered = [c for consumers in self.consumers.values() for c in consumers]
+        for cluster, consumers in self.consumers.items():
+            for consumer in consumers:
+                zk.ensure_path("{}/consumers-workload/{}/registry/nodes/{}".format(prefix, cluster, consumer))
+
+        removed = ["pl.allegro.removed.topic{}$subscription".format(i) for i in range(max(1, len(active) // 20))]
+        zk.ensure_path("{}/consumers-rate/runtime".format(prefix))
+        for subscription in active + removed:
+            consumers = self.random.sample(registered, 2)
+            if self.random.random() < 0.1:
+                consumers.append("dc1-gone{}".format(self.random.randint(1, 1000)))
+            for consumer in consumers:
+                path = "{}/consumers-rate/runtime/{}/{}".format(prefix, subscription, consumer)
+                zk.ensure_path("{}/rate".format(path))
+                zk.ensure_path("{}/history".format(path))
+
+    def write_owners_csv(self, filename, fraction=0.1):
+        """Writes an owner migration file covering `fraction` of topics and subscriptions."""
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Topic', 'Subscription', 'Owner Source', 'Owner ID'])
+            for group, topic in self.topics:
+                if self.random.random() < fraction:
+                    writer.writerow(["{}.{}".format(group, topic), '', 'Service Catalog', 'migrated'])
+            for group, topic, name in self.subscriptions:
+                if self.random.random() < fraction:
+                    writer.writerow(["{}.{}".format(group, topic), name, 'Service Catalog', 'migrated'])
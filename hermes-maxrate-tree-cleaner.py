@@ -1,10 +1,22 @@
-import json
+from functools import partial
 from random import randint
-from time import sleep
 
 import click
 from kazoo.client import KazooClient
 
+from hermes_tools import fleet, report
+from hermes_tools.consumer_state import ConsumerCleanupState
+from hermes_tools.deletion import SubtreeDeleter
+from hermes_tools.instrumentation import InstrumentedZooKeeper, Metrics, Progress
+from hermes_tools.journal import open_journal
+from hermes_tools.pipeline import Pipeline
+from hermes_tools.sharding import SHARD_BY, traverse_sharded
+from hermes_tools.snapshot import open_snapshot
+from hermes_tools.sorted_diff import DEFAULT_LIMIT, ExternalSort, missing
+from hermes_tools.throttling import create_throttle
+from hermes_tools.traversal import TraversalEngine
+from hermes_tools.visitors import ActiveSubscriptionCollector
+
 
 def connect_to_zookeeper(connection_string):
     zk = KazooClient(hosts=connection_string)
@@ -13,12 +25,34 @@ def connect_to_zookeeper(connection_string):
 
 
 @click.command()
-@click.option('--zookeeper', '-z', required=True, help='zookeeper connection string')
-@click.option('--prefix', '-p', required=True, default = '/run/hermes', help='path prefix')
+@click.option('--zookeeper', '-z', multiple=True, help='zookeeper connection string, repeat to clean several clusters at once')
+@click.option('--prefix', '-p', multiple=True, default=['/run/hermes'], help='path prefix, repeat to give one per --zookeeper')
+@click.option('--inventory', help="JSON file with clusters to clean at once, their zookeeper, prefix and limits: concurrency, ops-per-second, max-ops-per-second, batch-size, parallel-subtrees, processes")
 @click.option('--save', is_flag=True, help="write changes to zookeeper")
 @click.option('--fix-subscriptions', is_flag=True, help="cleanup max-rate tree at subscription level")
 @click.option('--fix-consumers', is_flag=True, help="cleanup max-rate tree at consumers level")
-def run_max_rate_tree_cleaner(zookeeper, prefix, save, fix_subscriptions, fix_consumers):
+@click.option('--from-snapshot', help="read the tree from a snapshot file instead of zookeeper, can't be used with --save")
+@click.option('--concurrency', '-c', default=1, type=click.IntRange(min=1), help='number of zookeeper requests kept in flight while reading the tree')
+@click.option('--ops-per-second', default=1.0, type=click.FloatRange(min=0, min_open=True), help='rate of removals, the starting rate with --adaptive')
+@click.option('--adaptive', is_flag=True, help="speed removals up while zookeeper latency stays low, back off when it rises")
+@click.option('--max-ops-per-second', default=50.0, type=click.FloatRange(min=0, min_open=True), help='upper limit of removal rate with --adaptive')
+@click.option('--target-latency', default=100, type=click.IntRange(min=1), help='removal latency in ms above which --adaptive backs off')
+@click.option('--batch-size', default=100, type=click.IntRange(min=1), help='number of nodes removed in one zookeeper transaction')
+@click.option('--parallel-subtrees', default=4, type=click.IntRange(min=1), help='number of subtrees removed at the same time')
+@click.option('--processes', default=1, type=click.IntRange(min=1), help='number of worker processes reading subscriptions, each with its own zookeeper session')
+@click.option('--shard-by', default='hash', type=click.Choice(SHARD_BY), help='split groups between processes by hash of the name or by number of topics')
+@click.option('--progress', 'show_progress', is_flag=True, help="show a live progress line with rate and ETA on stderr")
+@click.option('--metrics-out', help="write zookeeper latency histograms and counters to this file, Prometheus textfile format if it ends with .prom, JSON otherwise")
+@click.option('--journal', 'journal_file', help="record finished cleanup levels and removed subtrees in this file, so that an interrupted run can be resumed")
+@click.option('--resume', is_flag=True, help="skip cleanup levels the journal records as finished in a previous run")
+@click.option('--state', 'state_file', help="remember versions of max-rate subscription nodes found clean in this file, --fix-consumers lists only those changed since")
+@click.option('--sort-buffer', default=DEFAULT_LIMIT, type=click.IntRange(min=1), help="number of names held in memory while comparing the trees, more are sorted on disk")
+@click.option('--report', 'report_file', help="write findings to this file as JSON lines, gzip-compressed if it ends with .gz, and print only their counts")
+@click.option('--report-level', default=report.VERBOSE, type=click.Choice(report.LEVELS), help="findings to report: counts only, removals and problems, or also every node listed")
+def run_max_rate_tree_cleaner(zookeeper, prefix, inventory, save, fix_subscriptions, fix_consumers, from_snapshot, concurrency,
+                              ops_per_second, adaptive, max_ops_per_second, target_latency, batch_size, parallel_subtrees,
+                              processes, shard_by, show_progress, metrics_out, journal_file, resume, state_file, sort_buffer,
+                              report_file, report_level):
 
     """Removes unwanted nodes from consumers max-rate tree"""
 
@@ -27,28 +61,110 @@ Starting Hermes max-rate tree cleaner
 =====================================
     """)
 
-    zk = connect_to_zookeeper(zookeeper)
+    if resume and not journal_file:
+        raise click.UsageError("--resume needs the --journal of the interrupted run")
+    if journal_file and not save:
+        raise click.UsageError("--journal records removals, it can only be used with --save")
+
+    clusters = fleet.clusters(zookeeper, prefix, inventory, (
+        'concurrency', 'ops_per_second', 'max_ops_per_second', 'batch_size', 'parallel_subtrees', 'processes'
+    ), from_snapshot, not save)
+    if show_progress and len(clusters) > 1:
+        raise click.UsageError("--progress shows a single cluster, it can't be used with several")
+
+    findings = report.configure(report_file, report_level)
+    options = (save, fix_subscriptions, fix_consumers, concurrency, ops_per_second, adaptive, max_ops_per_second,
+               target_latency, batch_size, parallel_subtrees, processes, shard_by, show_progress, metrics_out,
+               journal_file, resume, state_file, sort_buffer)
+    try:
+        if len(clusters) > 1:
+            if save:
+                # asked once for all of them, workers can't read the terminal
+                confirm_calc([(cluster.zookeeper, cluster.prefix) for cluster in clusters])
+            fleet.run(clusters, clean_cluster, *options)
+        else:
+            clean_cluster(clusters[0], *options, from_snapshot=from_snapshot)
+    finally:
+        findings.close()
+
+
+def clean_cluster(cluster, save, fix_subscriptions, fix_consumers, concurrency, ops_per_second, adaptive,
+                  max_ops_per_second, target_latency, batch_size, parallel_subtrees, processes, shard_by, show_progress,
+                  metrics_out, journal_file, resume, state_file, sort_buffer, from_snapshot=None):
+    zookeeper, prefix = cluster.zookeeper, cluster.prefix
+    if from_snapshot:
+        connect = partial(open_snapshot, from_snapshot, prefix)
+    else:
+        connect = partial(connect_to_zookeeper, zookeeper)
+    zk = connect()
+
+    metrics = Metrics('hermes-maxrate-tree-cleaner') if show_progress or metrics_out else None
+    if metrics:
+        zk = InstrumentedZooKeeper(zk, metrics)
+    progress = Progress(metrics) if show_progress else None
+    journal = open_journal(cluster.file(journal_file), "hermes-maxrate-tree-cleaner {}{}".format(zookeeper, prefix), resume) if journal_file else None
+    state = ConsumerCleanupState(cluster.file(state_file), "{}{}".format(zookeeper or from_snapshot, prefix)) if state_file else None
+    metrics_out = cluster.file(metrics_out)
 
+    try:
+        clean(zk, zookeeper, prefix, save, fix_subscriptions, fix_consumers, cluster.limit('concurrency', concurrency),
+              cluster.limit('ops_per_second', ops_per_second), adaptive,
+              cluster.limit('max_ops_per_second', max_ops_per_second), target_latency,
+              cluster.limit('batch_size', batch_size), cluster.limit('parallel_subtrees', parallel_subtrees), progress,
+              cluster.limit('processes', processes), connect, shard_by, journal, state, sort_buffer,
+              confirmed=not cluster.alone)
+    finally:
+        if journal:
+            journal.close()
+        if progress:
+            progress.stop()
+        if metrics:
+            click.echo("\n" + metrics.summary())
+        if metrics_out:
+            metrics.write(metrics_out)
+            click.echo("Metrics written to " + metrics_out)
+
+
+def clean(zk, zookeeper, prefix, save, fix_subscriptions, fix_consumers, concurrency, ops_per_second, adaptive,
+          max_ops_per_second, target_latency, batch_size, parallel_subtrees, progress=None, processes=1, connect=None,
+          shard_by='hash', journal=None, state=None, sort_buffer=DEFAULT_LIMIT, confirmed=False):
     if not fix_subscriptions and not fix_consumers:
         click.echo("Nothing to do")
     else:
         ensure_valid_prefix(zk, prefix)
 
-    if save:
-        confirm_calc(zookeeper, prefix)
+    if save and not confirmed:
+        confirm_calc([(zookeeper, prefix)])
 
-    if fix_subscriptions:
-        subscriptions = get_all_active_subscriptions(zk, prefix)
+    throttle = create_throttle(zk, ops_per_second, adaptive, max_ops_per_second, target_latency / 1000.0)
+    deleter = SubtreeDeleter(zk, throttle, batch_size, parallel_subtrees, concurrency, progress=progress, journal=journal)
 
-        max_rate_subscriptions = get_all_maxrate_subscriptions(zk, prefix)
+    if fix_subscriptions and journal and journal.done('level', 'subscription'):
+        click.echo("\nMax-rate subscription nodes cleaned up in a previous run, skipping")
+    elif fix_subscriptions:
+        if progress:
+            progress.stage("Reading subscriptions")
+        subscriptions = get_all_active_subscriptions(zk, prefix, concurrency, processes, connect, shard_by, sort_buffer)
 
-        cleanup_maxrate_subscriptions(subscriptions, max_rate_subscriptions, zk, prefix, save)
-        check_existing_subscriptions_maxrate(subscriptions, max_rate_subscriptions)
+        max_rate_subscriptions = get_all_maxrate_subscriptions(zk, prefix, sort_buffer)
 
-    if fix_consumers:
-        consumers = get_consumers(zk, prefix)
-        max_rate_subscriptions = get_all_maxrate_subscriptions(zk, prefix)
-        cleanup_maxrate_consumers(consumers, max_rate_subscriptions, zk, prefix, save)
+        cleaned = cleanup_maxrate_subscriptions(subscriptions, max_rate_subscriptions, prefix, save, deleter)
+        check_existing_subscriptions_maxrate(subscriptions, max_rate_subscriptions)
+        if journal and cleaned:
+            journal.finish('level', 'subscription')
+
+    if fix_consumers and journal and journal.done('level', 'consumer'):
+        click.echo("\nMax-rate consumer nodes cleaned up in a previous run, skipping")
+    elif fix_consumers:
+        registry = {} if state else None
+        consumers = get_consumers(zk, prefix, registry, sort_buffer)
+        max_rate_subscriptions = get_all_maxrate_subscriptions(zk, prefix, sort_buffer)
+        cleaned = cleanup_maxrate_consumers(consumers, max_rate_subscriptions, zk, prefix, save, deleter, progress,
+                                            concurrency, state, registry, sort_buffer)
+        if state:
+            state.save()
+        if journal and cleaned:
+            journal.finish('level', 'consumer')
 
 
 def ensure_valid_prefix(zk, prefix):
@@ -58,11 +174,12 @@ def ensure_valid_prefix(zk, prefix):
         exit(1)
 
 
-def confirm_calc(zookeeper, prefix):
+def confirm_calc(clusters):
     a = randint(0, 9)
     b = randint(0, 9)
     click.echo("Will save changes made by this script to zookeeper:")
-    click.echo(" {} at path {}.".format(zookeeper, prefix))
+    for zookeeper, prefix in clusters:
+        click.echo(" {} at path {}.".format(zookeeper, prefix))
     click.echo("Are you sure? \n\nConfirm to proceed:")
 
     success = False
@@ -77,48 +194,33 @@ def confirm_calc(zookeeper, prefix):
     click.echo("OK")
 
 
-def get_all_active_subscriptions(zk, prefix):
-    click.echo("\nExisting subscriptions:")
-    active_count = 0
-    not_active_count = 0
-    could_not_parse_count = 0
-    subscriptions = list()
-    for group in zk.get_children("{}/groups".format(prefix)):
-        for topic in zk.get_children("{}/groups/{}/topics".format(prefix, group)):
-            for subscription in zk.get_children("{}/groups/{}/topics/{}/subscriptions".format(prefix, group, topic)):
-                subscription_as_node_name = "{}.{}${}".format(group, topic, subscription)
-                data, stat = zk.get("{}/groups/{}/topics/{}/subscriptions/{}".format(prefix, group, topic, subscription))
-                try:
-                    subscription_data = json.loads(data.decode("utf-8"))
-                    state = subscription_data['state']
-                    if state == 'ACTIVE':
-                        subscriptions.append(subscription_as_node_name)
-                        active_count += 1
-                        click.echo("{}. {}".format(active_count, subscription_as_node_name))
-                    else:
-                        not_active_count += 1
-                        click.echo("   {} is {}".format(subscription_as_node_name, state))
-                except ValueError:
-                    could_not_parse_count += 1
-                    click.echo("Unable to read sub data: {}.{} {}".format(group, topic, subscription))
-
-    click.echo("Found {} active subscriptions".format(active_count))
-    if not_active_count > 0:
-        click.echo("Found {} not active subscriptions - will clean up if needed".format(not_active_count))
-    if could_not_parse_count > 0:
-        click.echo("Found {} invalid subscriptions - will clean up if needed".format(could_not_parse_count))
+def create_collector(writer, sort_buffer=DEFAULT_LIMIT):
+    return [ActiveSubscriptionCollector(ExternalSort(limit=sort_buffer))]
 
-    return subscriptions
+
+def get_all_active_subscriptions(zk, prefix, concurrency=1, processes=1, connect=None, shard_by='hash',
+                                 sort_buffer=DEFAULT_LIMIT):
+    """Returns names of active subscriptions as a sorted stream."""
+    click.echo("\nExisting subscriptions:")
+    if processes > 1:
+        collector, = traverse_sharded(zk, prefix, None, create_collector, (sort_buffer,), connect, processes, shard_by,
+                                      concurrency)
+    else:
+        collector, = create_collector(None, sort_buffer)
+        TraversalEngine(zk, prefix, [collector], concurrency).run()
+    return collector.subscriptions
 
 
-def get_all_maxrate_subscriptions(zk, prefix):
+def get_all_maxrate_subscriptions(zk, prefix, sort_buffer=DEFAULT_LIMIT):
+    """Returns names of max-rate subscription nodes as a sorted stream."""
     click.echo("\nExisting max-rate subscription nodes:")
     count = 0
-    subscriptions = list()
+    subscriptions = ExternalSort(limit=sort_buffer)
     for subscription in zk.get_children("{}/consumers-rate/runtime".format(prefix)):
         subscriptions.append(subscription)
         count += 1
-        click.echo("{}. {}".format(count, subscription))
+        report.finding('max-rate-subscription', "{}. {}".format(count, subscription), report.VERBOSE,
+                       subscription=subscription)
     return subscriptions
 
 
@@ -128,71 +230,139 @@ def print_subscriptions(title, subscriptions):
         click.echo(" " + subscription)
 
 
-def cleanup_maxrate_subscriptions(subscriptions, max_rate_subscriptions, zk, prefix, save):
+def cleanup_maxrate_subscriptions(subscriptions, max_rate_subscriptions, prefix, save, deleter):
     click.echo("\nCleaning max-rate subscription nodes:")
-    count = 0
-    for max_rate_node in max_rate_subscriptions:
-        if max_rate_node not in subscriptions:
-            count += 1
-            path = "{}/consumers-rate/runtime/{}".format(prefix, max_rate_node)
-            if save:
-                click.echo(" Removing " + path)
-                zk.delete(path=path, recursive=True)
-                sleep(1)
+    paths = list()
+    for max_rate_node in missing(max_rate_subscriptions, subscriptions):
+        paths.append("{}/consumers-rate/runtime/{}".format(prefix, max_rate_node))
+    return remove_subtrees(paths, save, deleter, "subscription")
+
+
+def remove_subtrees(paths, save, deleter, kind):
+    if not save:
+        for path in paths:
+            report.finding('stale-' + kind, " Would remove " + path, path=path)
+        removed = len(paths)
+    else:
+        if deleter.progress:
+            deleter.progress.stage("Removing {} nodes".format(kind), len(paths))
+        removed = 0
+        for path, error in deleter.delete(paths).items():
+            if error is None:
+                removed += 1
+                report.finding('stale-' + kind, " Removed " + path, path=path)
             else:
-                click.echo(" Would remove " + path)
-    if count == 0:
+                report.finding('removal-failed', " Unable to remove {}: {!r}".format(path, error), path=path,
+                               error=repr(error))
+
+    if not paths:
         click.echo("All OK")
     else:
-        click.echo("{} {} subscription nodes from max-rate tree".format("Removed" if save else "Would remove", count))
+        click.echo("{} {} {} nodes from max-rate tree".format("Removed" if save else "Would remove", removed, kind))
+        if removed < len(paths):
+            click.echo("Failed to remove {} {} nodes".format(len(paths) - removed, kind))
+    return removed == len(paths)
 
 
 def check_existing_subscriptions_maxrate(subscriptions, max_rate_subscriptions):
     count = 0
     click.echo("\nChecking missing max-rate runtime configurations for existing subscriptions:")
-    for subscription in subscriptions:
-        if subscription not in max_rate_subscriptions:
-            count += 1
-            click.echo(" Subscription {} not found in max-rate tree".format(subscription))
+    for subscription in missing(subscriptions, max_rate_subscriptions):
+        count += 1
+        report.finding('missing-max-rate', " Subscription {} not found in max-rate tree".format(subscription),
+                       subscription=subscription)
     if count == 0:
         click.echo(" All OK")
     else:
         click.echo("Subscriptions missing max-rate runtime configurations: {}".format(count))
 
 
-def get_consumers(zk, prefix):
-    consumers = list()
+def get_consumers(zk, prefix, registry=None, sort_buffer=DEFAULT_LIMIT):
+    """Returns consumers of all clusters as a sorted stream, storing cversions of their registries in `registry`, when given."""
+    consumers = ExternalSort(limit=sort_buffer)
     for cluster in zk.get_children("{}/consumers-workload".format(prefix)):
-        for consumer in zk.get_children("{}/consumers-workload/{}/registry/nodes".format(prefix, cluster)):
-            consumers.append(consumer)
+        # the version comes with the very listing it describes
+        nodes, stat = zk.get_children("{}/consumers-workload/{}/registry/nodes".format(prefix, cluster), include_data=True)
+        if registry is not None:
+            registry[cluster] = stat.cversion
+        consumers.extend(nodes)
     click.echo("\nActive consumers ({}):".format(len(consumers)))
     for consumer in consumers:
-        click.echo(" " + consumer)
+        report.finding('consumer', " " + consumer, report.VERBOSE, consumer=consumer)
     return consumers
 
 
-def cleanup_maxrate_consumers(consumers, max_rate_subscriptions, zk, prefix, save):
+def cleanup_maxrate_consumers(consumers, max_rate_subscriptions, zk, prefix, save, deleter, progress=None, concurrency=1,
+                              state=None, registry=None, sort_buffer=DEFAULT_LIMIT):
+    """Removes max-rate nodes of consumers that are gone.
+
+    With `state`, subscriptions found clean by the previous run are checked
+    with one pipelined pass of `exists` and listed only when their pzxid
+    moved, or when `registry` - cversions from get_consumers() - changed. The
+    state is then replaced with pzxids of subscriptions found clean now.
+    """
     click.echo("\nCleaning max-rate consumer nodes:")
+    runtime = "{}/consumers-rate/runtime".format(prefix)
+    clean = {}
+    to_check = max_rate_subscriptions
+    if state is not None and not state.registry_changed(registry):
+        to_check = list()
+        pipeline = Pipeline(zk, concurrency)
+
+        def on_stat(path, stat, subscription):
+            if stat and state.unchanged(subscription, stat.pzxid):
+                clean[subscription] = stat.pzxid
+            else:
+                to_check.append(subscription)
+
+        for subscription in max_rate_subscriptions:
+            if state.known(subscription):
+                pipeline.exists(
+                    "{}/{}".format(runtime, subscription), lambda p, stat, subscription=subscription: on_stat(p, stat, subscription)
+                )
+            else:
+                to_check.append(subscription)
+        pipeline.run()
+        click.echo("Skipping {} subscriptions unchanged since the last cleanup".format(len(clean)))
+    elif state is not None:
+        click.echo("No previous cleanup recorded or consumer registry changed since, checking all subscriptions")
+
+    if progress:
+        progress.stage("Checking max-rate consumers", len(to_check))
     count = 0
-    removed = 0
-    for subscription in max_rate_subscriptions:
+    # consumer and subscription, sorted by consumer to be joined with the registered ones
+    nodes = ExternalSort(limit=sort_buffer)
+
+    def on_children(path, result, subscription):
+        nonlocal count
+        children, stat = result
+        if progress:
+            progress.advance()
         count += 1
-        click.echo("{}. Checking {}".format(count, subscription))
-        for node in zk.get_children("{}/consumers-rate/runtime/{}".format(prefix, subscription)):
-            if node not in consumers:
-                removed += 1
-                path = "{}/consumers-rate/runtime/{}/{}".format(prefix, subscription, node)
-                if save:
-                    click.echo(" Removing " + path)
-                    zk.delete(path=path, recursive=True)
-                    sleep(1)
-                else:
-                    click.echo(" Would remove " + path)
-    if removed == 0:
-        click.echo("All OK")
-    else:
-        click.echo("{} {} consumer nodes from max-rate tree".format("Removed" if save else "Would remove", removed))
-
+        report.finding('checked-subscription', "{}. Checking {}".format(count, subscription), report.VERBOSE,
+                       subscription=subscription)
+        nodes.extend("{}\t{}".format(node, subscription) for node in children)
+        clean[subscription] = stat.pzxid
+
+    pipeline = Pipeline(zk, concurrency)
+    for subscription in to_check:
+        path = "{}/{}".format(runtime, subscription)
+        pipeline.submit(
+            lambda path=path: zk.get_children_async(path, include_data=True), path,
+            lambda p, result, subscription=subscription: on_children(p, result, subscription)
+        )
+    pipeline.run()
+
+    paths = list()
+    for stale in missing(nodes, consumers, key=lambda node: node.split('\t', 1)[0]):
+        node, subscription = stale.split('\t')
+        paths.append("{}/{}/{}".format(runtime, subscription, node))
+        clean.pop(subscription, None)
+    nodes.close()
+
+    if state is not None:
+        state.update(registry, clean)
+    return remove_subtrees(paths, save, deleter, "consumer")
 
 if __name__ == '__main__':
     run_max_rate_tree_cleaner()
@@ -1,53 +1,186 @@
 import click
-import json
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from kazoo.client import KazooClient
+
+from hermes_tools import report
+from hermes_tools.http import HttpClient
+from hermes_tools.instrumentation import InstrumentedZooKeeper, Metrics, Progress
+from hermes_tools.journal import open_journal
+from hermes_tools.migration_cache import MigrationCache, digest
+from hermes_tools.snapshot import open_snapshot
+from hermes_tools.tree_copy import TreeCopier
 
 @click.command()
-@click.option('--source', '-s', required = True, help = 'URL to source Hermes Management')
-@click.option('--destination', '-d', required = True, help = 'URL to destination Hermes Management')
-@click.option('--authheader', '-a', required = True, help = 'Authorization header to send')
-@click.option('--authkey', '-k', required = True, help = 'Authorization header value')
+@click.option('--source', '-s', help = 'URL to source Hermes Management')
+@click.option('--destination', '-d', help = 'URL to destination Hermes Management')
+@click.option('--authheader', '-a', help = 'Authorization header to send')
+@click.option('--authkey', '-k', help = 'Authorization header value')
 @click.option('--dryrun', is_flag = True, help = "dry run mode won't modify anything")
-def migrator(source, destination, authheader, authkey, dryrun):
+@click.option('--workers', '-w', default = 1, type = click.IntRange(min = 1), help = 'number of groups / topics migrated in parallel')
+@click.option('--per-host', default = 8, type = click.IntRange(min = 1), help = 'maximum number of concurrent requests to one Hermes Management host')
+@click.option('--retries', default = 2, type = click.IntRange(min = 0), help = 'number of retries of idempotent requests failing with 5xx')
+@click.option('--cache', help = 'file with digests of already migrated entities, unchanged ones are skipped on destination')
+@click.option('--progress', 'show_progress', is_flag = True, help = 'show a live progress line with rate and ETA on stderr')
+@click.option('--metrics-out', help = 'write HTTP latency histograms and counters to this file, Prometheus textfile format if it ends with .prom, JSON otherwise')
+@click.option('--journal', 'journal_file', help = 'record migrated groups and topics in this file, so that an interrupted run can be resumed')
+@click.option('--resume', is_flag = True, help = 'skip groups and topics the journal records as migrated in a previous run')
+@click.option('--source-zookeeper', help = 'copy straight from source zookeeper instead of Hermes Management, with --destination-zookeeper')
+@click.option('--source-snapshot', help = 'copy from a snapshot file of source zookeeper, with --destination-zookeeper')
+@click.option('--source-prefix', default = '/run/hermes', help = 'path prefix in source zookeeper')
+@click.option('--destination-zookeeper', help = 'write groups and topics straight to destination zookeeper instead of Hermes Management')
+@click.option('--destination-prefix', default = '/run/hermes', help = 'path prefix in destination zookeeper')
+@click.option('--concurrency', '-c', default = 64, type = click.IntRange(min = 1), help = 'number of zookeeper requests kept in flight when copying between zookeepers')
+@click.option('--batch-size', '-b', default = 100, type = click.IntRange(min = 1), help = 'number of operations in one destination zookeeper transaction')
+@click.option('--report', 'report_file', help = 'write findings to this file as JSON lines, gzip-compressed if it ends with .gz, and print only their counts')
+@click.option('--report-level', default = report.VERBOSE, type = click.Choice(report.LEVELS), help = 'findings to report: counts only, or changes and problems')
+def migrator(source, destination, authheader, authkey, dryrun, workers, per_host, retries, cache, show_progress, metrics_out, journal_file, resume,
+             source_zookeeper, source_snapshot, source_prefix, destination_zookeeper, destination_prefix, concurrency, batch_size, report_file, report_level):
 
     """Migrates structure between Hermes clusters"""
 
+    if destination_zookeeper:
+        if bool(source_zookeeper) == bool(source_snapshot):
+            raise click.UsageError("--destination-zookeeper needs either --source-zookeeper or --source-snapshot")
+        if source or destination or cache or journal_file:
+            raise click.UsageError("--source, --destination, --cache and --journal are for Hermes Management, they can't be used with --destination-zookeeper")
+    elif source_zookeeper or source_snapshot:
+        raise click.UsageError("--source-zookeeper and --source-snapshot need --destination-zookeeper")
+    else:
+        for name, value in (('--source', source), ('--destination', destination), ('--authheader', authheader), ('--authkey', authkey)):
+            if not value:
+                raise click.UsageError("Missing option '{}'".format(name))
+    if resume and not journal_file:
+        raise click.UsageError("--resume needs the --journal of the interrupted run")
+    if journal_file and dryrun:
+        raise click.UsageError("--journal records migrated entities, it can't be used with --dryrun")
+
     click.echo("""
 Starting Hermes Migrator
 ==================================
     """)
 
-    auth = {authheader: authkey}
-
-    groups = fetchGroups(source)
-    migrate(groups, source, destination, auth, dryrun)
-
-
-def fetchGroups(source):
-    return requests.get("{}/groups".format(source)).json()
+    metrics = Metrics('hermes-migrator') if show_progress or metrics_out else None
+    progress = Progress(metrics) if show_progress else None
+    findings = report.configure(report_file, report_level)
+    if destination_zookeeper:
+        try:
+            copyTrees(source_zookeeper, source_snapshot, source_prefix, destination_zookeeper, destination_prefix, dryrun, concurrency, batch_size, metrics, progress)
+        finally:
+            findings.close()
+            reportMetrics(metrics, progress, metrics_out)
+        return
 
-def migrate(groups, source, destination, auth, dryrun):
-    allTopics = requests.get("{}/topics".format(source)).json()
-    for group in groups:
-        migrateGroup(group, topicsForGroup(allTopics, group), source, destination, auth, dryrun)
+    auth = {authheader: authkey}
+    http = HttpClient(per_host, retries, metrics = metrics)
+    migrationCache = MigrationCache(cache, source, destination) if cache else None
+    journal = open_journal(journal_file, "hermes-migrator {} -> {}".format(source, destination), resume) if journal_file else None
+    try:
+        groups = fetchGroups(http, source)
+        migrate(http, groups, source, destination, auth, dryrun, workers, migrationCache, progress, journal)
+    finally:
+        http.close()
+        if journal:
+            journal.close()
+        if migrationCache:
+            migrationCache.save()
+            click.echo("Skipped {} unchanged groups & topics".format(migrationCache.skipped))
+        findings.close()
+        reportMetrics(metrics, progress, metrics_out)
+
+
+def reportMetrics(metrics, progress, metrics_out):
+    if progress:
+        progress.stop()
+    if metrics:
+        click.echo("\n" + metrics.summary())
+    if metrics_out:
+        metrics.write(metrics_out)
+        click.echo("Metrics written to " + metrics_out)
+
+
+def connectToZookeeper(connectionString, metrics = None):
+    zk = KazooClient(hosts = connectionString)
+    zk.start()
+    return InstrumentedZooKeeper(zk, metrics) if metrics else zk
+
+def copyTrees(sourceZookeeper, sourceSnapshot, sourcePrefix, destinationZookeeper, destinationPrefix, dryrun, concurrency = 64, batchSize = 100, metrics = None, progress = None):
+    if sourceSnapshot:
+        sourceZk = open_snapshot(sourceSnapshot, sourcePrefix)
+        if metrics:
+            sourceZk = InstrumentedZooKeeper(sourceZk, metrics)
+    else:
+        sourceZk = connectToZookeeper(sourceZookeeper, metrics)
+    destinationZk = connectToZookeeper(destinationZookeeper, metrics)
+    try:
+        copier = TreeCopier(sourceZk, sourcePrefix, destinationZk, destinationPrefix, sanitizeGroup, sanitizeTopic, dryrun, concurrency, batchSize, progress)
+        copier.run()
+        click.echo(copier.summary())
+    finally:
+        for zk in (sourceZk, destinationZk):
+            zk.stop()
+            zk.close()
+
+
+def fetchGroups(http, source):
+    return http.get("{}/groups".format(source)).json()
+
+def migrate(http, groups, source, destination, auth, dryrun, workers = 1, cache = None, progress = None, journal = None):
+    allTopics = http.get("{}/topics".format(source)).json()
+    if progress:
+        progress.stage("Migrating groups & topics", len(groups) + len(topicsForGroups(allTopics, groups)))
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        try:
+            # a group has to exist on destination before its topics are created
+            groupFutures = {executor.submit(migrateGroup, http, group, source, destination, auth, dryrun, cache, journal): group for group in groups}
+            topicFutures = []
+            for future in as_completed(groupFutures):
+                topics = topicsForGroup(allTopics, groupFutures[future])
+                if future.result():
+                    for topic in topics:
+                        topicFutures.append(executor.submit(migrateTopic, http, topic, source, destination, auth, dryrun, cache, journal))
+                if progress:
+                    # topics of a group that could not be migrated are skipped
+                    progress.advance(1 if future.result() else 1 + len(topics))
+            for future in as_completed(topicFutures):
+                future.result()
+                if progress:
+                    progress.advance()
+        except BaseException:
+            executor.shutdown(wait = True, cancel_futures = True)
+            raise
 
 def topicsForGroup(allTopics, group):
     return [t for t in allTopics if t.rsplit('.', 1)[0] == group]
 
-def migrateGroup(group, topics, source, destination, auth, dryrun):
-    sourceGroupRequest = requests.get(groupUrl(source, group))
+def topicsForGroups(allTopics, groups):
+    groups = set(groups)
+    return [t for t in allTopics if t.rsplit('.', 1)[0] in groups]
+
+def migrateGroup(http, group, source, destination, auth, dryrun, cache = None, journal = None):
+    if journal and journal.done('group', group):
+        return True
+    sourceGroupRequest = http.get(groupUrl(source, group))
     if sourceGroupRequest.status_code != 200:
-        return
+        return False
     sourceGroupBody = sanitizeGroup(sourceGroupRequest.json())
 
-    r = requests.get(groupUrl(destination, group))
+    groupDigest = digest(sourceGroupBody)
+    if cache and cache.unchanged('groups', group, groupDigest):
+        return True
+
+    r = http.get(groupUrl(destination, group))
     if r.status_code == 500 or r.status_code == 404:
         if r.status_code == 500:
-            run(lambda: requests.delete(groupUrl(destination, group), headers = auth), dryrun, "Deleting corrupted group: {}".format(group))
-        run(lambda: requests.post("{}/groups".format(destination), headers = auth, json = sourceGroupBody), dryrun, "Creating missing group: {}".format(group))
+            run(lambda: http.delete(groupUrl(destination, group), headers = auth), dryrun, "Deleting corrupted group: {}".format(group), 'corrupted-group', group = group)
+        run(lambda: http.post("{}/groups".format(destination), headers = auth, json = sourceGroupBody), dryrun, "Creating missing group: {}".format(group), 'missing-group', group = group)
     else:
-        run(lambda: requests.put(groupUrl(destination, group), headers = auth, json = sourceGroupBody), dryrun, "Patching existing group: {}".format(group))
-    migrateTopics(topics, source, destination, auth, dryrun)
+        run(lambda: http.put(groupUrl(destination, group), headers = auth, json = sourceGroupBody), dryrun, "Patching existing group: {}".format(group), 'existing-group', group = group)
+
+    if cache and not dryrun:
+        cache.store('groups', group, groupDigest)
+    if journal:
+        journal.finish('group', group)
+    return True
 
 def sanitizeGroup(group):
     if 'contact' not in group:
@@ -59,29 +192,37 @@ def sanitizeGroup(group):
 def groupUrl(host, group):
     return "{}/groups/{}".format(host, group)
 
-def migrateTopics(topics, source, destination, auth, dryrun):
-    for topic in topics:
-        migrateTopic(topic, source, destination, auth, dryrun)
-
-def migrateTopic(topic, source, destination, auth, dryrun):
-    sourceTopicRequest = requests.get(topicUrl(source, topic))
+def migrateTopic(http, topic, source, destination, auth, dryrun, cache = None, journal = None):
+    if journal and journal.done('topic', topic):
+        return
+    sourceTopicRequest = http.get(topicUrl(source, topic))
     if sourceTopicRequest.status_code != 200:
         return
 
     sourceTopicBody = sanitizeTopic(sourceTopicRequest.json())
-    schemaRequest = requests.get("{}/topics/{}/schema".format(source, topic))
+    schemaRequest = http.get("{}/topics/{}/schema".format(source, topic))
     sourceHasSchema = schemaRequest.status_code == 200
-    if sourceHasSchema:
-        schema = schemaRequest.json()
+    schema = schemaRequest.json() if sourceHasSchema else None
+
+    topicDigest = digest(sourceTopicBody, schema)
+    if cache and cache.unchanged('topics', topic, topicDigest):
+        return
 
-    r = requests.get(topicUrl(destination, topic))
+    r = http.get(topicUrl(destination, topic))
     if r.status_code == 500 or r.status_code == 404:
         if r.status_code == 500:
-            run(lambda: requests.delete(topicUrl(destination, topic), headers = auth), dryrun, "Deleting corrupted topic: {}".format(topic))
-        run(lambda: requests.post("{}/topics".format(destination), headers = auth, json = sourceTopicBody), dryrun, "Creating missing topic: {}".format(topic))
+            run(lambda: http.delete(topicUrl(destination, topic), headers = auth), dryrun, "Deleting corrupted topic: {}".format(topic), 'corrupted-topic', topic = topic)
+        run(lambda: http.post("{}/topics".format(destination), headers = auth, json = sourceTopicBody), dryrun, "Creating missing topic: {}".format(topic), 'missing-topic', topic = topic)
         if sourceHasSchema:
-            if requests.get("{}/topics/{}/schema".format(destination, topic)).status_code == 204:
-                run(lambda: requests.post("{}/topics/{}/schema".format(destination, topic), headers = auth, json = schema), dryrun, "Creating missing schema for topic: {}".format(topic))
+            if http.get("{}/topics/{}/schema".format(destination, topic)).status_code == 204:
+                run(lambda: http.post("{}/topics/{}/schema".format(destination, topic), headers = auth, json = schema), dryrun, "Creating missing schema for topic: {}".format(topic), 'missing-schema', topic = topic)
+
+    # destination failing to answer leaves the topic unchecked, it's looked at again on the next run
+    checked = r.status_code in (200, 404, 500)
+    if cache and not dryrun and checked:
+        cache.store('topics', topic, topicDigest)
+    if journal and checked:
+        journal.finish('topic', topic)
 
 def sanitizeTopic(topicBody):
     if 'migratedFromJsonType' in topicBody:
@@ -96,17 +237,17 @@ def topicUrl(host, topic):
     return "{}/topics/{}".format(host, topic)
 
 
-def run(f, dryrun, text):
+def run(f, dryrun, text, kind, **fields):
     if dryrun:
         message = "DRYRUN: {}".format(text)
     else:
         message = text
-    click.echo(message)
+    report.finding(kind, message, **fields)
 
     if not dryrun:
         r = f()
         if r.status_code == 400 or r.status_code == 500 or r.status_code == 403:
-            click.echo("{}".format(r.json()))
+            report.finding('failed-request', "{}".format(r.json()), status = r.status_code, response = r.json(), **fields)
         r.raise_for_status()
 
 if __name__ == '__main__':
@@ -1,180 +1,122 @@
+import os
+from functools import partial
+
 import click
-import json
-import csv
 from kazoo.client import KazooClient
 
+from hermes_tools import fleet, report
+from hermes_tools.journal import open_journal
+from hermes_tools.ownership import OwnerMigrator, iter_csv_configuration, load_csv_configuration
+from hermes_tools.sharding import SHARD_BY, traverse_sharded
+from hermes_tools.snapshot import open_snapshot
+from hermes_tools.traversal import DirectTraversal, TraversalEngine
+from hermes_tools.writes import BatchWriter
+
 @click.command()
-@click.option('--zookeeper', '-z', required = True, help = 'zookeeper connection string')
-@click.option('--prefix', '-p', required = True, default = '/run/hermes', help = 'path prefix')
+@click.option('--zookeeper', '-z', multiple = True, help = 'zookeeper connection string, repeat to run on several clusters at once')
+@click.option('--prefix', '-p', multiple = True, default = ['/run/hermes'], help = 'path prefix, repeat to give one per --zookeeper')
+@click.option('--inventory', help = 'JSON file with clusters to run on at once, their zookeeper, prefix and limits: concurrency, batch-size')
 @click.option('--source', '-s', required = True, help = "CSV file to load migration information from: Topic,Subscription,Owner Source,Owner ID")
 @click.option('--dryrun', is_flag = True, help = "dry run mode won't modify instances")
-def sc_migrator(zookeeper, prefix, source, dryrun):
+@click.option('--concurrency', '-c', default = 1, type = click.IntRange(min = 1), help = 'number of zookeeper requests kept in flight, 1 walks the tree serially')
+@click.option('--batch-size', '-b', default = 50, type = click.IntRange(min = 1), help = 'number of version-checked writes sent in one zookeeper transaction')
+@click.option('--from-snapshot', help = 'read the tree from a snapshot file instead of zookeeper, requires --dryrun')
+@click.option('--direct', is_flag = True, help = 'fetch only topics and subscriptions listed in CSV instead of walking the whole tree')
+@click.option('--chunk-size', default = 10000, type = click.IntRange(min = 1), help = 'number of CSV rows held in memory at once with --direct')
+@click.option('--processes', default = 1, type = click.IntRange(min = 1), help = 'number of worker processes sharing the groups, each with its own zookeeper session')
+@click.option('--shard-by', default = 'hash', type = click.Choice(SHARD_BY), help = 'split groups between processes by hash of the name or by number of topics')
+@click.option('--journal', 'journal_file', help = 'record finished groups and applied writes in this file, so that an interrupted run can be resumed')
+@click.option('--resume', is_flag = True, help = 'skip groups the journal records as finished in a previous run')
+@click.option('--report', 'report_file', help = 'write findings to this file as JSON lines, gzip-compressed if it ends with .gz, and print only their counts')
+@click.option('--report-level', default = report.VERBOSE, type = click.Choice(report.LEVELS), help = 'findings to report: counts only, owner changes and problems, or also every topic found in CSV')
+def sc_migrator(zookeeper, prefix, inventory, source, dryrun, concurrency, batch_size, from_snapshot, direct, chunk_size, processes, shard_by, journal_file, resume, report_file, report_level):
 
     """Changes ownership of topics / subscriptions based on CSV file input"""
 
+    clusters = fleet.clusters(zookeeper, prefix, inventory, ('concurrency', 'batch_size'), from_snapshot, dryrun)
+    if direct and processes > 1:
+        raise click.UsageError("--processes shares the whole tree walk, it can't be used with --direct")
+    if resume and not journal_file:
+        raise click.UsageError("--resume needs the --journal of the interrupted run")
+    if journal_file and (dryrun or processes > 1):
+        raise click.UsageError("--journal records writes of a single process, it can't be used with --dryrun or --processes")
+
     click.echo("""
 Starting Hermes Ownership Migrator
 ==================================
     """)
 
-    data = load_csv_configuration(source)
-    for k, v in data.topics.items():
-        click.echo("{} {}".format(k, v))
-
-    zk = connect_to_zookeeper(zookeeper)
-    traverse(zk, prefix, data, dryrun)
+    findings = report.configure(report_file, report_level)
+    try:
+        if len(clusters) > 1:
+            fleet.run(clusters, migrate_cluster, source, dryrun, concurrency, batch_size, direct, chunk_size, processes, shard_by, journal_file, resume)
+        else:
+            migrate_cluster(clusters[0], source, dryrun, concurrency, batch_size, direct, chunk_size, processes, shard_by, journal_file, resume, from_snapshot)
+    finally:
+        findings.close()
+
+def migrate_cluster(cluster, source, dryrun, concurrency, batch_size, direct, chunk_size, processes, shard_by, journal_file, resume, from_snapshot = None):
+    if from_snapshot:
+        connect = partial(open_snapshot, from_snapshot, cluster.prefix)
+    else:
+        connect = partial(connect_to_zookeeper, cluster.zookeeper)
+    zk = connect()
+    concurrency = cluster.limit('concurrency', concurrency)
+    journal = None
+    if journal_file:
+        # chunks are journaled by number, which points at other rows with another chunk size or an edited CSV file
+        csv = os.stat(source)
+        run = "hermes-owner-migrator {}{} {} ({} bytes, modified {}){}".format(
+            cluster.zookeeper, cluster.prefix, source, csv.st_size, csv.st_mtime_ns,
+            " --direct --chunk-size {}".format(chunk_size) if direct else ""
+        )
+        journal = open_journal(cluster.file(journal_file), run, resume)
+    writer = BatchWriter(zk, cluster.limit('batch_size', batch_size), journal = journal)
+    try:
+        if direct:
+            traverse_direct(zk, writer, cluster.prefix, iter_csv_configuration(source, chunk_size), dryrun, concurrency, journal)
+        else:
+            data = load_csv_configuration(source)
+            click.echo("Loaded {} topics from {}".format(len(data.topics), source))
+            traverse(zk, writer, cluster.prefix, data, dryrun, concurrency, processes, connect, shard_by, journal)
+        writer.flush()
+    finally:
+        if journal:
+            journal.close()
+
+    if not dryrun:
+        click.echo(writer.summary())
 
 def connect_to_zookeeper(connectionString):
     zk = KazooClient(hosts=connectionString)
     zk.start()
     return zk
 
-class Owner:
-    def __init__(self, source, id):
-        self.source = source
-        self.id = id
-
-    def __str__(self):
-        return "{{'source': {}, 'id': {}}}".format(self.source, self.id)
-
-class TopicMigrationData:
-    def __init__(self, name, owner: Owner):
-        self.name = name
-        self.owner = owner
-    
-    def __str__(self):
-        return "{{'name': {}, 'owner': {}, 'id': {}}}".format(self.name, self.owner.source, self.owner.id)
-
-class SubscriptionMigrationData:
-    def __init__(self, topic_name, name, owner: Owner):
-        self.topic_name = topic_name
-        self.name = name
-        self.owner = owner
-    
-    def __str__(self):
-        return "{{'name': {}${}, 'owner': {} 'id': {}}}".format(self.topic_name, self.name, self.owner.source, self.owner.id)
-
-class TopicAndSubMigrationData:
-    def __init__(self, topic: TopicMigrationData):
-        self.topic = topic
-        self.subscriptions = {}
-    
-    def add_subscription(self, sub: SubscriptionMigrationData):
-        self.subscriptions["{}${}".format(sub.topic_name, sub.name)] = sub
-    
-    def has_subscriptions(self):
-        return len(self.subscriptions) > 0
-    
-    def subscription(self, fqdn) -> SubscriptionMigrationData:
-        return self.subscriptions.get(fqdn, None)
-
-    def __str__(self):
-        return "{{'topic': {}, 'subscriptions': {}}}".format(self.topic, [s.__str__() for s in self.subscriptions.values()])
-
-class MigrationData:
-    def __init__(self):
-        self.topics = {}
-    
-    def add_topic(self, topic: TopicMigrationData) -> TopicAndSubMigrationData:
-        if topic.name not in self.topics:
-            self.topics[topic.name] = TopicAndSubMigrationData(topic)
-        return self.topics[topic.name]
-    
-    def add_subscription(self, sub: SubscriptionMigrationData) -> TopicAndSubMigrationData:
-        if sub.topic_name not in self.topics:
-            self.topics[sub.topic_name] = TopicAndSubMigrationData(None)
-        self.topics[sub.topic_name].add_subscription(sub)
-        return self.topics[sub.topic_name]
-    
-    def find_topic(self, topicAndGroup) -> TopicAndSubMigrationData:
-        return self.topics.get(topicAndGroup, None)
-
-
-def load_csv_configuration(source) -> MigrationData:
-    migrationData = MigrationData()
-    with open(source, newline='') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',')
-        for row in reader:
-            if bool(row.get('Subscription', '')):
-                migrationData.add_subscription(
-                    SubscriptionMigrationData(row['Topic'], row['Subscription'], Owner(row['Owner Source'], row['Owner ID']))
-                )
-            else:
-                migrationData.add_topic(
-                    TopicMigrationData(row['Topic'], Owner(row['Owner Source'], row['Owner ID']))
-                )
-    return migrationData
-
-def traverse(zk, prefix, migration_data, dryrun):
-    counter = 0
-    for group in zk.get_children("{}/groups".format(prefix)):
-        for topic in zk.get_children("{}/groups/{}/topics".format(prefix, group)):
-            topicWithGroup = "{}.{}".format(group, topic)
-
-            topicAndSub = migration_data.find_topic(topicWithGroup)
-
-            if topicAndSub:
-                click.echo("Found topic: {} in CSV data".format(topicWithGroup))
-
-                if topicAndSub.topic:
-                    try:
-                        data, stat = zk.get("{}/groups/{}/topics/{}".format(prefix, group, topic))
-                        topicData = json.loads(data.decode("utf-8"))
-
-                        if 'owner' not in topicData:
-                            topicData['owner'] = {'source': 'unknown', 'id': 'unknown'}
-
-                        if topicData['owner']['source'] != topicAndSub.topic.owner.source or topicData['owner']['id'] != topicAndSub.topic.owner.id:
-
-                            click.echo("Changing owner of topic: {} from: {} to: {} {}".format(
-                                topicWithGroup, topicData['owner']['id'], topicAndSub.topic.owner.source, topicAndSub.topic.owner.id
-                            ))
-
-                            topicData['owner']['source'] = topicAndSub.topic.owner.source
-                            topicData['owner']['id'] = topicAndSub.topic.owner.id
-
-                            counter = counter + 1
-
-                            if not dryrun:
-                               zk.set(
-                                   "{}/groups/{}/topics/{}".format(prefix, group, topic),
-                                   bytes(json.dumps(topicData), "utf-8")
-                               )
-                    except ValueError:
-                       click.echo("Unable to read topic data: {}".format(topicWithGroup)) 
-                    
-                if topicAndSub.has_subscriptions():
-                    for sub in zk.get_children("{}/groups/{}/topics/{}/subscriptions/".format(prefix, group, topic)):
-                        subscription_fqdn = "{}${}".format(topicWithGroup, sub)
-                        subMigrationData = topicAndSub.subscription(subscription_fqdn)
-
-                        if subMigrationData:
-                            try:
-                                data, stat = zk.get("{}/groups/{}/topics/{}/subscriptions/{}".format(prefix, group, topic, sub))
-                                subData = json.loads(data.decode("utf-8"))
-
-                                if 'owner' not in subData:
-                                    subData['owner'] = {'source': 'unknown', 'id': 'unknown'}
-
-                                if subData['owner']['source'] != subMigrationData.owner.source or subData['owner']['id'] != subMigrationData.owner.id:
-                                    click.echo("Changing owner of sub: {} from: {} to: {} {}".format(
-                                        subscription_fqdn, subData['owner']['id'], subMigrationData.owner.source, subMigrationData.owner.id
-                                    ))
-
-                                    subData['owner']['source'] = subMigrationData.owner.source
-                                    subData['owner']['id'] = subMigrationData.owner.id
-
-                                    counter = counter + 1
-
-                                    if not dryrun:
-                                       zk.set(
-                                           "{}/groups/{}/topics/{}/subscriptions/{}".format(prefix, group, topic, sub),
-                                           bytes(json.dumps(subData), "utf-8")
-                                       )
-                            except ValueError:
-                                click.echo("Unable to read sub data: {}".format(subscription_fqdn))
-
-    click.echo("Changed owner for {} topics & subs".format(counter))
+def create_visitors(writer, migration_data, dryrun):
+    return [OwnerMigrator(migration_data, writer, dryrun)]
+
+def traverse(zk, writer, prefix, migration_data, dryrun, concurrency = 1, processes = 1, connect = None, shard_by = 'hash', journal = None):
+    if processes > 1:
+        traverse_sharded(zk, prefix, writer, create_visitors, (migration_data, dryrun), connect, processes, shard_by, concurrency)
+    elif journal:
+        # a group is finished once its writes are committed, not when it's been read
+        groups = [g for g in zk.get_children("{}/groups".format(prefix)) if not journal.done('group', g)]
+        on_group = lambda group: writer.when_written(partial(journal.finish, 'group', group), "{}/groups/{}/".format(prefix, group))
+        TraversalEngine(zk, prefix, create_visitors(writer, migration_data, dryrun), concurrency, groups, on_group).run()
+    else:
+        TraversalEngine(zk, prefix, create_visitors(writer, migration_data, dryrun), concurrency).run()
+
+def traverse_direct(zk, writer, prefix, chunks, dryrun, concurrency = 1, journal = None):
+    migrator = OwnerMigrator(None, writer, dryrun)
+    for number, migration_data in enumerate(chunks):
+        if journal and journal.done('chunk', number):
+            continue
+        migrator.migration_data = migration_data
+        mark = writer.mark()
+        DirectTraversal(zk, prefix, [migrator], migration_data.targets(), concurrency).walk()
+        if journal:
+            writer.when_written(partial(journal.finish, 'chunk', number), since = mark)
+    migrator.finish()
 
 if __name__ == '__main__':
     sc_migrator()
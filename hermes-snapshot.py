@@ -0,0 +1,41 @@
+import time
+
+import click
+from kazoo.client import KazooClient
+
+from hermes_tools.snapshot import take_snapshot
+
+
+def connect_to_zookeeper(connection_string):
+    zk = KazooClient(hosts=connection_string)
+    zk.start()
+    return zk
+
+
+@click.command()
+@click.option('--zookeeper', '-z', required=True, help='zookeeper connection string')
+@click.option('--prefix', '-p', required=True, default='/run/hermes', help='path prefix')
+@click.option('--output', '-o', required=True, help='snapshot file, refreshed incrementally if it already exists')
+@click.option('--full', is_flag=True, help="download the whole tree even if the snapshot file already exists")
+@click.option('--concurrency', '-c', default=64, type=click.IntRange(min=1), help='number of zookeeper requests kept in flight')
+def snapshot(zookeeper, prefix, output, full, concurrency):
+
+    """Saves Hermes groups, topics, subscriptions and consumer trees to a local file"""
+
+    click.echo("""
+Starting Hermes snapshot
+=====================================
+    """)
+
+    zk = connect_to_zookeeper(zookeeper)
+    started = time.monotonic()
+    builder = take_snapshot(zk, zookeeper, prefix, output, concurrency, incremental=not full)
+    zk.stop()
+
+    click.echo("Saved {} nodes to {} in {:.1f}s ({} fetched, {} unchanged)".format(
+        len(builder.nodes), output, time.monotonic() - started, builder.fetched, builder.reused
+    ))
+
+
+if __name__ == '__main__':
+    snapshot()
@@ -1,12 +1,33 @@
+from functools import partial
+
 import click
-import json
 from kazoo.client import KazooClient
 
+from hermes_tools import fleet, report
+from hermes_tools.ownership import OwnerMigrator, load_csv_configuration
+from hermes_tools.sharding import SHARD_BY, traverse_sharded
+from hermes_tools.snapshot import open_snapshot
+from hermes_tools.traversal import TraversalEngine
+from hermes_tools.visitors import SupportTeamFixer
+from hermes_tools.watcher import TreeWatcher
+from hermes_tools.writes import BatchWriter
+
 @click.command()
-@click.option('--zookeeper', '-z', required = True, help = 'zookeeper connection string')
-@click.option('--prefix', '-p', required = True, default = '/run/hermes', help = 'path prefix')
+@click.option('--zookeeper', '-z', multiple = True, help = 'zookeeper connection string, repeat to run on several clusters at once')
+@click.option('--prefix', '-p', multiple = True, default = ['/run/hermes'], help = 'path prefix, repeat to give one per --zookeeper')
+@click.option('--inventory', help = 'JSON file with clusters to run on at once, their zookeeper, prefix and limits: concurrency, batch-size, processes')
 @click.option('--dryrun', is_flag = True, help = "dry run mode won't modify instances")
-def malformedInstancesFixer(zookeeper, prefix, dryrun):
+@click.option('--concurrency', '-c', default = 1, type = click.IntRange(min = 1), help = 'number of zookeeper requests kept in flight, 1 walks the tree serially')
+@click.option('--batch-size', '-b', default = 50, type = click.IntRange(min = 1), help = 'number of version-checked writes sent in one zookeeper transaction')
+@click.option('--from-snapshot', help = 'read the tree from a snapshot file instead of zookeeper, requires --dryrun')
+@click.option('--owners', help = 'also change owners listed in this CSV file, as hermes-owner-migrator.py does, in the same pass')
+@click.option('--watch', is_flag = True, help = 'keep running after the first pass and fix nodes as soon as they are created or changed')
+@click.option('--debounce', default = 1.0, type = click.FloatRange(min = 0), help = 'seconds without changes to wait for before fixing a burst of changes with --watch')
+@click.option('--processes', default = 1, type = click.IntRange(min = 1), help = 'number of worker processes sharing the groups, each with its own zookeeper session')
+@click.option('--shard-by', default = 'hash', type = click.Choice(SHARD_BY), help = 'split groups between processes by hash of the name or by number of topics')
+@click.option('--report', 'report_file', help = 'write findings to this file as JSON lines, gzip-compressed if it ends with .gz, and print only their counts')
+@click.option('--report-level', default = report.VERBOSE, type = click.Choice(report.LEVELS), help = 'findings to report: counts only, changes and problems, or also every subscription visited')
+def malformedInstancesFixer(zookeeper, prefix, inventory, dryrun, concurrency, batch_size, from_snapshot, owners, watch, debounce, processes, shard_by, report_file, report_level):
 
     """Walks around Hermes and looks for stuff"""
 
@@ -15,8 +36,46 @@ Starting Hermes traverser
 ==================================
     """)
 
-    zk = connectToZookeeper(zookeeper)
-    traverse(zk, prefix, dryrun)
+    if watch and processes > 1:
+        raise click.UsageError("--watch runs in a single process, it can't be used with --processes")
+
+    if from_snapshot and watch:
+        raise click.UsageError("--watch needs a zookeeper connection, it can't be used with --from-snapshot")
+    clusters = fleet.clusters(zookeeper, prefix, inventory, ('concurrency', 'batch_size', 'processes'), from_snapshot, dryrun)
+
+    migrationData = load_csv_configuration(owners) if owners else None
+
+    findings = report.configure(report_file, report_level)
+    try:
+        if len(clusters) > 1:
+            fleet.run(clusters, fixCluster, dryrun, concurrency, batch_size, migrationData, watch, debounce, processes, shard_by)
+        else:
+            fixCluster(clusters[0], dryrun, concurrency, batch_size, migrationData, watch, debounce, processes, shard_by, from_snapshot)
+    finally:
+        findings.close()
+
+
+def fixCluster(cluster, dryrun, concurrency, batchSize, migrationData, watch, debounce, processes, shardBy, fromSnapshot = None):
+    if fromSnapshot:
+        connect = partial(open_snapshot, fromSnapshot, cluster.prefix)
+    else:
+        connect = partial(connectToZookeeper, cluster.zookeeper)
+    zk = connect()
+    concurrency = cluster.limit('concurrency', concurrency)
+    processes = cluster.limit('processes', processes)
+
+    writer = BatchWriter(zk, cluster.limit('batch_size', batchSize))
+    try:
+        if watch:
+            watchTree(zk, writer, cluster.prefix, dryrun, concurrency, debounce, migrationData)
+        else:
+            traverse(zk, writer, cluster.prefix, dryrun, concurrency, migrationData, processes, connect, shardBy)
+    except KeyboardInterrupt:
+        click.echo("Interrupted")
+    writer.flush()
+
+    if not dryrun:
+        click.echo(writer.summary())
 
 
 def connectToZookeeper(connectionString):
@@ -24,22 +83,20 @@ def connectToZookeeper(connectionString):
     zk.start()
     return zk
 
-def traverse(zk, prefix, dryrun):
-    for group in zk.get_children("{}/groups".format(prefix)):
-        for topic in zk.get_children("{}/groups/{}/topics".format(prefix, group)):
-            for subscription in zk.get_children("{}/groups/{}/topics/{}/subscriptions".format(prefix, group, topic)):
-                data, stat = zk.get("{}/groups/{}/topics/{}/subscriptions/{}".format(prefix, group, topic, subscription))
-                try:
-                    subscriptionData = json.loads(data.decode("utf-8"))
-                    if 'supportTeam' not in subscriptionData:
-                        if dryrun:
-                            click.echo("Subscription without supportTeam: {} {}".format(subscription, subscriptionData));
-                        else:
-                            click.echo("Fixing subscription without supportTeam: {}".format(subscription));
-                            subscriptionData['supportTeam'] = 'undefined'
-                            zk.set("{}/groups/{}/topics/{}/subscriptions/{}".format(prefix, group, topic, subscription), json.dumps(subscriptionData))
-                except ValueError:
-                    click.echo("Unable to read sub data: {}.{} {}".format(group, topic, subscription))
+def createVisitors(writer, dryrun, migrationData = None):
+    visitors = [SupportTeamFixer(writer, dryrun)]
+    if migrationData:
+        visitors.append(OwnerMigrator(migrationData, writer, dryrun))
+    return visitors
+
+def traverse(zk, writer, prefix, dryrun, concurrency = 1, migrationData = None, processes = 1, connect = None, shardBy = 'hash'):
+    if processes > 1:
+        traverse_sharded(zk, prefix, writer, createVisitors, (dryrun, migrationData), connect, processes, shardBy, concurrency)
+    else:
+        TraversalEngine(zk, prefix, createVisitors(writer, dryrun, migrationData), concurrency).run()
+
+def watchTree(zk, writer, prefix, dryrun, concurrency = 1, debounce = 1.0, migrationData = None):
+    TreeWatcher(zk, prefix, createVisitors(writer, dryrun, migrationData), writer, concurrency, debounce).run()
 
 if __name__ == '__main__':
     malformedInstancesFixer()
@@ -0,0 +1,128 @@
+import json
+import re
+from json import decoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_scan_once = json.JSONDecoder().scan_once
+_scanstring = decoder.scanstring
+_whitespace = decoder.WHITESPACE.match
+
+# first member of a document written with spaces after ':' and ','
+FIRST_MEMBER = re.compile(rb'\s*\{\s*"(?:[^"\\]|\\.)*"\s*:\s')
+
+
+def loads(data):
+    """Decodes a payload straight from bytes, with orjson when it is installed."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def members(text):
+    """Yields (key, value, start, end) of every top-level member of a JSON object, in document order.
+
+    Values are decoded by the C scanner of the json module, start and end are
+    their offsets in `text`. Stopping early skips the rest of the document,
+    which is then not validated either.
+    """
+    index = _whitespace(text, 0).end()
+    if text[index:index + 1] != '{':
+        raise ValueError("Expected a JSON object")
+    index = _whitespace(text, index + 1).end()
+    if text[index:index + 1] == '}':
+        return
+    while True:
+        if text[index:index + 1] != '"':
+            raise ValueError("Expected a key at {}".format(index))
+        key, index = _scanstring(text, index + 1)
+        index = _whitespace(text, index).end()
+        if text[index:index + 1] != ':':
+            raise ValueError("Expected ':' at {}".format(index))
+        start = _whitespace(text, index + 1).end()
+        try:
+            value, index = _scan_once(text, start)
+        except StopIteration:
+            raise ValueError("Expected a value at {}".format(start))
+        yield key, value, start, index
+        index = _whitespace(text, index).end()
+        separator = text[index:index + 1]
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError("Expected ',' or '}}' at {}".format(index))
+        index = _whitespace(text, index + 1).end()
+
+
+def extract(data, keys):
+    """Returns a dict of those top-level `keys` that are present in the payload.
+
+    The payload is parsed as a whole, so that a truncated or otherwise invalid
+    one raises ValueError, and a repeated key has its last value, like with
+    json.loads.
+    """
+    document = loads(data)
+    if not isinstance(document, dict):
+        raise ValueError("Expected a JSON object")
+    return {key: document[key] for key in keys if key in document}
+
+
+def patch(data, changes):
+    """Sets top-level keys of a payload and returns it as bytes; every other byte of it is kept as is.
+
+    Missing keys are appended after the last member and values of existing
+    keys are replaced in place, written with the same spacing as the document
+    uses. Raises ValueError for invalid payloads.
+    """
+    document = loads(data)
+    if not isinstance(document, dict):
+        raise ValueError("Expected a JSON object")
+    compact = FIRST_MEMBER.match(data) is None
+    colon = b':' if compact else b': '
+
+    def encode(value):
+        separators = (',', ':') if compact else (', ', ': ')
+        return json.dumps(value, ensure_ascii=False, separators=separators).encode("utf-8")
+
+    replaced = [key for key in changes if key in document]
+    if replaced:
+        data = _replace_found(data, document, changes, replaced, encode, colon) or _replace_scanned(data, changes, replaced, encode)
+
+    added = [encode(key) + colon + encode(value) for key, value in changes.items() if key not in document]
+    if added:
+        head = data[:data.rindex(b'}')]
+        last = head.rstrip()
+        separator = b',' if compact else b', '
+        data = last + (separator if document else b'') + separator.join(added) + data[len(last):]
+    return data
+
+
+def _replace_found(data, document, changes, replaced, encode, colon):
+    """Replaces members found by searching for them as Hermes writes them, or returns None.
+
+    Most payloads were written by the same JSON library, so the current
+    member usually appears verbatim and the whole document need not be
+    scanned. The result is checked with a parse, as a nested member could look
+    the same.
+    """
+    patched = data
+    for key in replaced:
+        member = encode(key) + colon
+        current = member + encode(document[key])
+        if patched.count(current) != 1:
+            return None
+        patched = patched.replace(current, member + encode(changes[key]))
+    expected = dict(document, **{key: changes[key] for key in replaced})
+    return patched if loads(patched) == expected else None
+
+
+def _replace_scanned(data, changes, replaced, encode):
+    text = data.decode("utf-8")
+    spans = {key: (start, end) for key, _, start, end in members(text) if key in changes}
+    for start, end, key in sorted(((spans[k][0], spans[k][1], k) for k in replaced), reverse=True):
+        text = text[:start] + encode(changes[key]).decode("utf-8") + text[end:]
+    return text.encode("utf-8")
+
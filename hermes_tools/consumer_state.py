@@ -0,0 +1,42 @@
+import json
+import os
+
+
+class ConsumerCleanupState:
+
+    """Versions of the max-rate tree found clean by the last consumer cleanup, persisted between runs.
+
+    While no consumer registry changed its cversion, the same consumers are
+    alive, and a max-rate subscription node whose pzxid did not move has the
+    same consumer children as when it was found clean. Such subscriptions
+    need not be listed again. Entries are kept per cluster, so one file can
+    serve several of them.
+    """
+
+    def __init__(self, filename, cluster):
+        self.filename = filename
+        self.clusters = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.clusters = json.load(f)
+        self.entries = self.clusters.setdefault(cluster, {'registry': {}, 'subscriptions': {}})
+
+    def registry_changed(self, registry):
+        return self.entries['registry'] != registry
+
+    def unchanged(self, subscription, pzxid):
+        return self.entries['subscriptions'].get(subscription) == pzxid
+
+    def known(self, subscription):
+        return subscription in self.entries['subscriptions']
+
+    def update(self, registry, clean):
+        """Replaces the state with `registry` cversions per cluster and pzxids of subscriptions found clean."""
+        self.entries['registry'] = registry
+        self.entries['subscriptions'] = clean
+
+    def save(self):
+        tmp = "{}.tmp".format(self.filename)
+        with open(tmp, 'w') as f:
+            json.dump(self.clusters, f)
+        os.replace(tmp, self.filename)
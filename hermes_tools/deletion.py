@@ -0,0 +1,128 @@
+import threading
+import time
+
+from kazoo.exceptions import RolledBackError, RuntimeInconsistency
+
+from hermes_tools.pipeline import Pipeline
+
+
+class CommitTimer:
+
+    """Latency of a commit, taken when its result arrives rather than when the pipeline gets to it.
+
+    Results are handed over in submission order, after the commits started
+    in the meantime have each waited for the throttle, so the time until a
+    callback runs says little about the ensemble.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latency = None
+        self.completed = threading.Event()
+
+    def link(self, result):
+        result.rawlink(self.complete)
+        return result
+
+    def complete(self, result):
+        self.latency = time.monotonic() - self.started
+        self.completed.set()
+
+    def wait(self):
+        # kazoo runs linked callbacks on its completion thread, right after the result is set
+        self.completed.wait()
+        return self.latency
+
+
+class SubtreeDeleter:
+
+    """Removes whole subtrees in multi transactions instead of kazoo's serial recursive delete.
+
+    Subtrees are listed with pipelined get_children calls, then their nodes are
+    removed deepest first in transactions of `batch_size` deletes. Batches of
+    one subtree are committed one after another, up to `parallel` subtrees are
+    removed at the same time. Every commit waits for the throttle first.
+    Finished subtrees are counted on `progress` and recorded in `journal`,
+    when given.
+    """
+
+    def __init__(self, zk, throttle, batch_size=100, parallel=4, concurrency=64, attempts=2, progress=None, journal=None):
+        self.zk = zk
+        self.throttle = throttle
+        self.batch_size = max(1, batch_size)
+        self.parallel = parallel
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.progress = progress
+        self.journal = journal
+
+    def delete(self, roots):
+        """Returns a dict of subtree root -> None if it was removed, or the error that prevented it."""
+        results = {}
+        remaining = list(roots)
+        for _ in range(self.attempts):
+            if not remaining:
+                break
+            self.remove(self.list(remaining), results)
+            remaining = [root for root in remaining if results[root] is not None]
+        if self.progress:
+            self.progress.advance(len(remaining))
+        return results
+
+    def list(self, roots):
+        subtrees = {root: [] for root in roots}
+        pipeline = Pipeline(self.zk, self.concurrency)
+
+        def on_children(path, children, root, depth):
+            subtrees[root].append((depth, path))
+            for child in children:
+                child_path = "{}/{}".format(path, child)
+                pipeline.get_children(child_path, lambda p, c, depth=depth + 1: on_children(p, c, root, depth))
+
+        for root in roots:
+            pipeline.get_children(root, lambda p, c, root=root: on_children(p, c, root, 0))
+        pipeline.run()
+        return subtrees
+
+    def remove(self, subtrees, results):
+        pipeline = Pipeline(self.zk, self.parallel)
+
+        def commit(root, batches):
+            timing = {}
+
+            def start():
+                self.throttle.wait()
+                transaction = self.zk.transaction()
+                for path in batches[0]:
+                    transaction.delete(path)
+                timing['timer'] = CommitTimer()
+                return timing['timer'].link(transaction.commit_async())
+
+            pipeline.submit(start, root, lambda r, outcome: on_commit(r, batches, outcome, timing['timer']))
+
+        def on_commit(root, batches, outcome, timer):
+            self.throttle.observe(timer.wait())
+            errors = [r for r in outcome if isinstance(r, Exception) and not isinstance(r, (RolledBackError, RuntimeInconsistency))]
+            if errors:
+                results[root] = errors[0]
+            elif len(batches) > 1:
+                commit(root, batches[1:])
+            else:
+                self.removed(root)
+
+        for root, nodes in subtrees.items():
+            # children first, so that every node is empty when its delete is applied
+            paths = [path for depth, path in sorted(nodes, key=lambda node: -node[0])]
+            batches = [paths[i:i + self.batch_size] for i in range(0, len(paths), self.batch_size)]
+            results[root] = None
+            if batches:
+                commit(root, batches)
+            else:
+                self.removed(root)
+        pipeline.run()
+
+    def removed(self, root):
+        if self.progress:
+            self.progress.advance()
+        if self.journal:
+            self.journal.finish('subtree', root)
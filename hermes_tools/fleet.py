@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import sys
+import time
+
+import click
+
+from hermes_tools import report
+from hermes_tools.sharding import worker_pool
+
+
+class Cluster:
+
+    """A ZooKeeper ensemble a script runs against, with its own limits overriding those given as options."""
+
+    __slots__ = ('name', 'zookeeper', 'prefix', 'limits', 'alone')
+
+    def __init__(self, zookeeper, prefix, name=None, limits=None, alone=True):
+        self.zookeeper = zookeeper
+        self.prefix = prefix
+        self.name = name or zookeeper
+        self.limits = limits or {}
+        self.alone = alone
+
+    def limit(self, option, default):
+        return self.limits.get(option, default)
+
+    def file(self, filename):
+        """Returns `filename` as is for a cluster run alone, with the cluster name before its extension otherwise."""
+        if not filename or self.alone:
+            return filename
+        base, extension = os.path.splitext(filename)
+        return "{}.{}{}".format(base, re.sub(r'[^\w.-]', '_', self.name), extension)
+
+
+def load_inventory(filename, limits=()):
+    """Reads clusters from a JSON file: {"name": {"zookeeper": "...", "prefix": "...", "concurrency": 64, ...}}.
+
+    `prefix` defaults to /run/hermes. Other keys are the `limits` - names of
+    the script's options, like concurrency or ops-per-second - that the
+    cluster runs with instead of the values given on the command line.
+    """
+    with open(filename) as f:
+        inventory = json.load(f)
+    if not isinstance(inventory, dict) or not inventory:
+        raise click.UsageError("Inventory {} should map cluster names to their zookeeper and prefix".format(filename))
+
+    clusters = []
+    for name, entry in inventory.items():
+        entry = {key.replace('-', '_'): value for key, value in entry.items()}
+        if 'zookeeper' not in entry:
+            raise click.UsageError("Cluster {} in inventory {} has no zookeeper".format(name, filename))
+        unknown = set(entry) - {'zookeeper', 'prefix'} - set(limits)
+        if unknown:
+            raise click.UsageError("Unknown keys of cluster {} in inventory {}: {}, expected zookeeper, prefix{}".format(
+                name, filename, ", ".join(sorted(unknown)), "".join(", " + limit.replace('_', '-') for limit in limits)
+            ))
+        zookeeper = entry.pop('zookeeper')
+        prefix = entry.pop('prefix', '/run/hermes')
+        clusters.append(Cluster(zookeeper, prefix, name, entry))
+    return clusters
+
+
+def clusters(zookeepers, prefixes, inventory=None, limits=(), snapshot=None, dryrun=False):
+    """Returns clusters given with repeated --zookeeper and --prefix options, in an inventory file, or in a snapshot.
+
+    A single --prefix applies to every --zookeeper, otherwise there must be
+    one prefix per zookeeper. A --from-snapshot file holds a single tree and,
+    being read-only, can only be used in a dry run. Raises UsageError when no
+    cluster is given.
+    """
+    if snapshot:
+        if not dryrun:
+            raise click.UsageError("--from-snapshot is read-only, it can only be used in a dry run")
+        if inventory or len(prefixes) > 1:
+            raise click.UsageError("--from-snapshot reads a single tree, it can't be used with --inventory or several --prefix")
+        return [Cluster(None, prefixes[0])]
+
+    if inventory:
+        if zookeepers:
+            raise click.UsageError("--inventory lists clusters, it can't be used with --zookeeper")
+        targets = load_inventory(inventory, limits)
+    elif len(prefixes) > 1 and len(prefixes) != len(zookeepers):
+        raise click.UsageError("Give one --prefix, or one per --zookeeper")
+    else:
+        targets = [
+            Cluster(zookeeper, prefixes[i] if len(prefixes) > 1 else prefixes[0]) for i, zookeeper in enumerate(zookeepers)
+        ]
+    if not targets:
+        raise click.UsageError("Missing option '--zookeeper' / '-z', '--inventory' or '--from-snapshot'")
+
+    names = [cluster.name for cluster in targets]
+    if len(set(names)) < len(names):
+        # the same ensemble under different prefixes
+        for cluster in targets:
+            cluster.name = "{}{}".format(cluster.zookeeper, cluster.prefix)
+    for cluster in targets:
+        cluster.alone = len(targets) == 1
+    return targets
+
+
+class PrefixedOutput:
+
+    """Prefixes every line written to `stream`, so that output of clusters run at once can be told apart."""
+
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.line_start = True
+
+    def write(self, text):
+        lines = text.split("\n")
+        prefixed = []
+        for i, line in enumerate(lines):
+            if i > 0:
+                prefixed.append("\n")
+                self.line_start = True
+            if line and self.line_start:
+                prefixed.append(self.prefix)
+                self.line_start = False
+            prefixed.append(line)
+        return self.stream.write("".join(prefixed))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_cluster(job, cluster, args, report_part):
+    """Runs in a worker process, with the cluster's output prefixed and its own part of the report.
+
+    Returns counters of the findings, seconds taken and the error the job
+    failed with, if any, so that findings reported before a failure are
+    counted too. The worker may run another cluster afterwards.
+    """
+    stdout = sys.stdout
+    sys.stdout = PrefixedOutput(stdout, "[{}] ".format(cluster.name))
+    cluster_report = report.configure(*report_part)
+    start = time.monotonic()
+    error = None
+    try:
+        job(cluster, *args)
+    except (Exception, SystemExit) as e:
+        error = repr(e)
+    finally:
+        cluster_report.close(summary=False)
+        sys.stdout.flush()
+        sys.stdout = stdout
+    return cluster_report.counters(), time.monotonic() - start, error
+
+
+def run(targets, job, *args):
+    """Runs `job(cluster, *args)` against all `targets` at once, in as many worker processes.
+
+    Every worker connects and works on its own, so the whole run takes as
+    long as the slowest cluster. Findings of all clusters go to the report of
+    this process, followed by totals per cluster, which are also printed. A
+    cluster failing doesn't stop the others, the run fails at the end.
+    """
+    click.echo("Running on {} clusters: {}".format(len(targets), ", ".join(cluster.name for cluster in targets)))
+    findings = report.current
+    parts = [findings.part(index, cluster.name) for index, cluster in enumerate(targets)]
+    results = []
+    with worker_pool(len(targets)) as executor:
+        futures = [executor.submit(run_cluster, job, cluster, args, part) for cluster, part in zip(targets, parts)]
+        for cluster, future, part in zip(targets, futures, parts):
+            try:
+                counters, elapsed, error = future.result()
+                if error:
+                    status = "failed after {:.1f}s: {}".format(elapsed, error)
+                else:
+                    status = "done in {:.1f}s".format(elapsed)
+            except Exception as e:
+                # the worker died, findings it reported can't be counted
+                counters = {}
+                status = "failed: {!r}, findings not counted".format(e)
+            findings.include(part[0], counters, cluster.name, status)
+            results.append((cluster, status, counters))
+
+    click.echo("\nClusters:")
+    for cluster, status, counters in results:
+        click.echo(" {} {}".format(cluster.name, status))
+        for kind, count in sorted(counters.items()):
+            click.echo("{:>10}  {}".format(count, kind))
+    failed = [cluster.name for cluster, status, counters in results if status.startswith("failed")]
+    if failed:
+        raise click.ClickException("Failed on {} of {} clusters: {}".format(len(failed), len(targets), ", ".join(failed)))
@@ -0,0 +1,95 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+class HttpClient:
+
+    """Thread-safe HTTP client with keep-alive sessions per host.
+
+    At most `per_host` requests run against one host at a time, whatever the
+    number of threads using the client. Idempotent requests answered with 5xx
+    or failing to connect are retried with exponential backoff; the last
+    response is returned when retries run out, so callers still see the status.
+    With `metrics`, every attempt and every parsed response body is recorded.
+    """
+
+    def __init__(self, per_host=8, retries=2, backoff=0.5, metrics=None):
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host(self, url):
+        parts = urlsplit(url)
+        key = "{}://{}".format(parts.scheme, parts.netloc)
+        with self.lock:
+            if key not in self.hosts:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.per_host)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.hosts[key] = (session, threading.BoundedSemaphore(self.per_host))
+            return self.hosts[key]
+
+    def request(self, method, url, **kwargs):
+        session, limit = self.host(url)
+        retriable = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                with limit:
+                    response = self.send(session, method, url, **kwargs)
+                if response.status_code < 500 or not retriable or attempt >= self.retries:
+                    return response
+            except requests.ConnectionError:
+                if not retriable or attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def send(self, session, method, url, **kwargs):
+        if self.metrics is None:
+            return session.request(method, url, **kwargs)
+
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.metrics.record('http', method, time.monotonic() - started, error=True)
+            raise
+        size = len(response.content) + len(response.request.body or b"")
+        self.metrics.record('http', method, time.monotonic() - started, size, response.status_code >= 500)
+
+        parse = response.json
+
+        def json(**kwargs):
+            with self.metrics.timer('json', 'parse', len(response.content)):
+                return parse(**kwargs)
+        response.json = json
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session, _ in self.hosts.values():
+                session.close()
+            self.hosts.clear()
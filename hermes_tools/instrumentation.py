@@ -0,0 +1,375 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+
+# upper bounds of latency buckets in seconds, the last one catches everything slower
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class OperationStats:
+    __slots__ = ('count', 'errors', 'bytes', 'seconds', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds, size, error):
+        self.count += 1
+        self.errors += int(error)
+        self.bytes += size
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+
+    """Counts, latency histograms and bytes of ZooKeeper, HTTP and JSON parsing operations.
+
+    Operations are keyed by client ('zookeeper', 'http', 'json') and name. The
+    report is written as JSON, or in Prometheus textfile format when the file
+    name ends with .prom.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def record(self, client, operation, seconds, size=0, error=False):
+        with self.lock:
+            stats = self.operations.get((client, operation))
+            if stats is None:
+                stats = self.operations[(client, operation)] = OperationStats()
+            stats.add(seconds, size, error)
+
+    @contextmanager
+    def timer(self, client, operation, size=0):
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.record(client, operation, time.monotonic() - started, size, True)
+            raise
+        self.record(client, operation, time.monotonic() - started, size)
+
+    def count(self, client):
+        with self.lock:
+            return sum(stats.count for (c, _), stats in self.operations.items() if c == client)
+
+    def summary(self):
+        lines = ["{:<28}{:>10}{:>8}{:>10}{:>10}{:>10}".format('operation', 'count', 'errors', 'avg ms', 'p99 ms', 'MB')]
+        with self.lock:
+            for (client, operation), stats in sorted(self.operations.items()):
+                lines.append("{:<28}{:>10}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+                    "{} {}".format(client, operation), stats.count, stats.errors,
+                    stats.seconds / stats.count * 1000, stats.quantile(0.99) * 1000, stats.bytes / 2 ** 20
+                ))
+        return "\n".join(lines)
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'script': self.script,
+                'started': self.started,
+                'duration': time.time() - self.started,
+                'operations': [{
+                    'client': client,
+                    'operation': operation,
+                    'count': stats.count,
+                    'errors': stats.errors,
+                    'bytes': stats.bytes,
+                    'seconds': stats.seconds,
+                    'p50': stats.quantile(0.5),
+                    'p90': stats.quantile(0.9),
+                    'p99': stats.quantile(0.99),
+                    'max': stats.max,
+                    'buckets': {str(bound): count for bound, count in zip(BUCKETS, stats.buckets)},
+                } for (client, operation), stats in sorted(self.operations.items())],
+            }
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP hermes_tools_operation_seconds Latency of ZooKeeper, HTTP and JSON parsing operations.",
+            "# TYPE hermes_tools_operation_seconds histogram",
+        ]
+        totals = []
+        with self.lock:
+            for (client, operation), stats in sorted(self.operations.items()):
+                labels = 'script="{}",client="{}",operation="{}"'.format(self.script, client, operation)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, stats.buckets):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append('hermes_tools_operation_seconds_bucket{{{},le="{}"}} {}'.format(labels, le, cumulative))
+                lines.append("hermes_tools_operation_seconds_sum{{{}}} {}".format(labels, stats.seconds))
+                lines.append("hermes_tools_operation_seconds_count{{{}}} {}".format(labels, stats.count))
+                totals.append((labels, stats))
+        for name, help, attribute in (('errors', 'Failed operations.', 'errors'), ('bytes', 'Bytes sent and received.', 'bytes')):
+            lines.append("# HELP hermes_tools_operation_{}_total {}".format(name, help))
+            lines.append("# TYPE hermes_tools_operation_{}_total counter".format(name))
+            for labels, stats in totals:
+                lines.append("hermes_tools_operation_{}_total{{{}}} {}".format(name, labels, getattr(stats, attribute)))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        tmp = "{}.tmp".format(filename)
+        with open(tmp, 'w') as f:
+            if filename.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_json(), f, indent=2)
+        # node_exporter's textfile collector must never see a half written file
+        os.replace(tmp, filename)
+
+
+def response_size(operation, value):
+    if operation == 'get':
+        return len(value[0] or b"")
+    if operation == 'get_children':
+        children = value[0] if isinstance(value, tuple) else value
+        return sum(len(child) for child in children)
+    return 0
+
+
+def timed(result, metrics, operation, started, size=0):
+    """Records `result` in `metrics` once kazoo completes it and returns it as is.
+
+    Results of clients that can't notify on completion are wrapped in a
+    TimedResult and recorded when first read.
+    """
+    if not hasattr(result, 'rawlink'):
+        return TimedResult(result, metrics, operation, started, size)
+
+    def completed(result):
+        successful = result.successful()
+        value = result.value if successful else None
+        failed = not successful or operation == 'multi' and any(isinstance(r, Exception) for r in value)
+        metrics.record('zookeeper', operation, time.monotonic() - started,
+                       size + (response_size(operation, value) if successful else 0), failed)
+    result.rawlink(completed)
+    return result
+
+
+class TimedResult:
+
+    """Async result recorded when it is first read, for clients whose results can't notify on completion."""
+
+    def __init__(self, result, metrics, operation, started, size):
+        self.result = result
+        self.metrics = metrics
+        self.operation = operation
+        self.started = started
+        self.size = size
+        self.recorded = False
+
+    def get(self, block=True, timeout=None):
+        try:
+            value = self.result.get(block, timeout)
+        except Exception:
+            self.record(0, True)
+            raise
+        failed = self.operation == 'multi' and any(isinstance(r, Exception) for r in value)
+        self.record(response_size(self.operation, value), failed)
+        return value
+
+    def rawlink(self, callback):
+        if hasattr(self.result, 'rawlink'):
+            self.result.rawlink(lambda result: callback(self))
+            return
+        # without notifications, the result is complete once it has been read
+        try:
+            self.get()
+        except Exception:
+            pass
+        callback(self)
+
+    def record(self, size, error):
+        if not self.recorded:
+            self.recorded = True
+            self.metrics.record('zookeeper', self.operation, time.monotonic() - self.started, self.size + size, error)
+
+
+class InstrumentedTransaction:
+
+    def __init__(self, transaction, metrics):
+        self.transaction = transaction
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.transaction, name)
+
+    def commit(self):
+        started = time.monotonic()
+        results = self.transaction.commit()
+        self.metrics.record('zookeeper', 'multi', time.monotonic() - started,
+                            error=any(isinstance(r, Exception) for r in results))
+        return results
+
+    def commit_async(self):
+        started = time.monotonic()
+        return timed(self.transaction.commit_async(), self.metrics, 'multi', started)
+
+
+class InstrumentedZooKeeper:
+
+    """Wraps KazooClient, or a Snapshot, and records every request in Metrics.
+
+    Latency of async requests is taken when kazoo completes them; with clients
+    that can't report completion, when the result is read.
+    """
+
+    def __init__(self, zk, metrics):
+        self.zk = zk
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.zk, name)
+
+    def call(self, operation, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            value = getattr(self.zk, operation)(*args, **kwargs)
+        except Exception:
+            self.metrics.record('zookeeper', operation, time.monotonic() - started, error=True)
+            raise
+        size = response_size(operation, value) + request_size(operation, args, kwargs)
+        self.metrics.record('zookeeper', operation, time.monotonic() - started, size)
+        return value
+
+    def call_async(self, operation, *args, **kwargs):
+        started = time.monotonic()
+        result = getattr(self.zk, "{}_async".format(operation))(*args, **kwargs)
+        return timed(result, self.metrics, operation, started, request_size(operation, args, kwargs))
+
+    def get(self, *args, **kwargs):
+        return self.call('get', *args, **kwargs)
+
+    def get_children(self, *args, **kwargs):
+        return self.call('get_children', *args, **kwargs)
+
+    def exists(self, *args, **kwargs):
+        return self.call('exists', *args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self.call('set', *args, **kwargs)
+
+    def create(self, *args, **kwargs):
+        return self.call('create', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.call('delete', *args, **kwargs)
+
+    def get_async(self, *args, **kwargs):
+        return self.call_async('get', *args, **kwargs)
+
+    def get_children_async(self, *args, **kwargs):
+        return self.call_async('get_children', *args, **kwargs)
+
+    def exists_async(self, *args, **kwargs):
+        return self.call_async('exists', *args, **kwargs)
+
+    def set_async(self, *args, **kwargs):
+        return self.call_async('set', *args, **kwargs)
+
+    def delete_async(self, *args, **kwargs):
+        return self.call_async('delete', *args, **kwargs)
+
+    def transaction(self):
+        return InstrumentedTransaction(self.zk.transaction(), self.metrics)
+
+
+def request_size(operation, args, kwargs):
+    if operation in ('set', 'create'):
+        value = args[1] if len(args) > 1 else kwargs.get('value', b"")
+        return len(value or b"")
+    return 0
+
+
+class Progress:
+
+    """Live progress line on stderr with the rate and ETA of the current stage.
+
+    The line is redrawn every `interval` seconds from a background thread, so
+    callers only have to count finished items with advance(). Stages without
+    a known total show the rate of ZooKeeper and HTTP requests instead.
+    """
+
+    def __init__(self, metrics, interval=1.0):
+        self.metrics = metrics
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.label = None
+        self.total = None
+        self.done = 0
+        self.started = time.monotonic()
+        self.requests = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.refresh, daemon=True)
+        self.thread.start()
+
+    def stage(self, label, total=None):
+        with self.lock:
+            self.label = label
+            self.total = total
+            self.done = 0
+            self.started = time.monotonic()
+            self.requests = self.metrics.count('zookeeper') + self.metrics.count('http')
+
+    def advance(self, count=1):
+        with self.lock:
+            self.done += count
+
+    def line(self):
+        with self.lock:
+            if self.label is None:
+                return None
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            requests = self.metrics.count('zookeeper') + self.metrics.count('http') - self.requests
+            parts = [self.label]
+            if self.total is not None:
+                rate = self.done / elapsed
+                eta = format_duration((self.total - self.done) / rate) if rate else '?'
+                parts.append("{}/{} ({:.1f}/s, ETA {})".format(self.done, self.total, rate, eta))
+            parts.append("{} requests ({:.1f}/s)".format(requests, requests / elapsed))
+            return " | ".join(parts)
+
+    def refresh(self):
+        while not self.stopped.wait(self.interval):
+            line = self.line()
+            if line:
+                click.echo("\r{}\x1b[K".format(line), nl=False, err=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        line = self.line()
+        if line:
+            click.echo("\r{}\x1b[K".format(line), err=True)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
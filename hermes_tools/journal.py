@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+
+import click
+
+
+class Journal:
+
+    """Append-only record of finished work, so that an interrupted run can be resumed where it stopped.
+
+    Every line is a JSON object, either a finished unit of work - a group, a
+    topic, a removed subtree - or a write applied to a node, with the version
+    it resulted in. Entries are buffered and written with one fsync every
+    `sync_every` entries or `sync_interval` seconds, so a crash loses at most
+    that tail, which the next run simply does again. The first line names the
+    run, a journal of another script, cluster or input is refused on resume.
+    """
+
+    def __init__(self, filename, run, resume=False, sync_every=100, sync_interval=1.0):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.finished = set()
+        self.buffer = []
+        self.last_sync = time.monotonic()
+
+        loaded = resume and os.path.exists(filename) and self.load(run)
+        self.file = open(filename, 'a' if loaded else 'w')
+        if not loaded:
+            self.buffer.append({'run': run})
+            self.sync()
+        self.resumed = len(self.finished)
+
+    def load(self, run):
+        """Reads entries of a previous run and returns True, or False when the journal is empty."""
+        valid = 0
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = None
+                if entry is None or not line.endswith(b'\n'):
+                    # last line cut short by a crash
+                    break
+                if valid == 0 and entry.get('run') != run:
+                    raise ValueError("{} is a journal of '{}', not of '{}'".format(self.filename, entry.get('run'), run))
+                if 'done' in entry:
+                    self.finished.add((entry['done'], entry['name']))
+                valid += len(line)
+        # entries are appended after the last complete one
+        os.truncate(self.filename, valid)
+        return valid > 0
+
+    def done(self, kind, name):
+        return (kind, name) in self.finished
+
+    def finish(self, kind, name):
+        self.append({'done': kind, 'name': name})
+        with self.lock:
+            self.finished.add((kind, name))
+
+    def written(self, path, version):
+        self.append({'path': path, 'version': version})
+
+    def append(self, entry):
+        with self.lock:
+            self.buffer.append(entry)
+            if len(self.buffer) >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+                self.write_buffer()
+
+    def sync(self):
+        with self.lock:
+            self.write_buffer()
+
+    def write_buffer(self):
+        if self.buffer:
+            self.file.write("".join(json.dumps(entry) + "\n" for entry in self.buffer))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer = []
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def open_journal(filename, run, resume):
+    """Opens the journal of `run` for the scripts, refusing a journal of another run as a usage error."""
+    try:
+        journal = Journal(filename, run, resume)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if journal.resumed:
+        click.echo("Resuming: {} parts finished in a previous run will be skipped".format(journal.resumed))
+    return journal
@@ -0,0 +1,218 @@
+import csv
+import sys
+
+import click
+
+from hermes_tools import codec, report
+from hermes_tools.traversal import Visitor
+
+UNKNOWN_OWNER = {'source': 'unknown', 'id': 'unknown'}
+
+
+class Owner:
+    __slots__ = ('source', 'id')
+
+    def __init__(self, source, id):
+        self.source = source
+        self.id = id
+
+    def __str__(self):
+        return "{{'source': {}, 'id': {}}}".format(self.source, self.id)
+
+
+class TopicMigrationData:
+    __slots__ = ('name', 'owner')
+
+    def __init__(self, name, owner: Owner):
+        self.name = name
+        self.owner = owner
+
+    def __str__(self):
+        return "{{'name': {}, 'owner': {}, 'id': {}}}".format(self.name, self.owner.source, self.owner.id)
+
+
+class SubscriptionMigrationData:
+    __slots__ = ('topic_name', 'name', 'owner')
+
+    def __init__(self, topic_name, name, owner: Owner):
+        self.topic_name = topic_name
+        self.name = name
+        self.owner = owner
+
+    def __str__(self):
+        return "{{'name': {}${}, 'owner': {} 'id': {}}}".format(self.topic_name, self.name, self.owner.source, self.owner.id)
+
+
+class TopicAndSubMigrationData:
+    __slots__ = ('topic', 'subscriptions')
+
+    def __init__(self, topic: TopicMigrationData):
+        self.topic = topic
+        self.subscriptions = {}
+
+    def add_subscription(self, sub: SubscriptionMigrationData):
+        self.subscriptions["{}${}".format(sub.topic_name, sub.name)] = sub
+
+    def has_subscriptions(self):
+        return len(self.subscriptions) > 0
+
+    def subscription(self, fqdn) -> SubscriptionMigrationData:
+        return self.subscriptions.get(fqdn, None)
+
+    def __str__(self):
+        return "{{'topic': {}, 'subscriptions': {}}}".format(self.topic, [s.__str__() for s in self.subscriptions.values()])
+
+
+class MigrationData:
+    __slots__ = ('topics',)
+
+    def __init__(self):
+        self.topics = {}
+
+    def add_topic(self, topic: TopicMigrationData) -> TopicAndSubMigrationData:
+        if topic.name not in self.topics:
+            self.topics[topic.name] = TopicAndSubMigrationData(topic)
+        elif self.topics[topic.name].topic is None:
+            # subscription rows of this topic came first
+            self.topics[topic.name].topic = topic
+        return self.topics[topic.name]
+
+    def add_subscription(self, sub: SubscriptionMigrationData) -> TopicAndSubMigrationData:
+        if sub.topic_name not in self.topics:
+            self.topics[sub.topic_name] = TopicAndSubMigrationData(None)
+        self.topics[sub.topic_name].add_subscription(sub)
+        return self.topics[sub.topic_name]
+
+    def find_topic(self, topicAndGroup) -> TopicAndSubMigrationData:
+        return self.topics.get(topicAndGroup, None)
+
+    def targets(self):
+        for name, topicAndSub in self.topics.items():
+            yield name, [sub.name for sub in topicAndSub.subscriptions.values()]
+
+
+def load_csv_configuration(source) -> MigrationData:
+    return next(iter_csv_configuration(source), MigrationData())
+
+
+def iter_csv_configuration(source, chunk_size=None):
+    """Reads the CSV file in chunks of `chunk_size` rows, or in one piece when it is None.
+
+    Owners are shared between rows and topic names are interned, so rows of
+    one team or one topic don't keep copies of the same strings.
+    """
+    owners = {}
+    migrationData = MigrationData()
+    rows = 0
+    with open(source, newline='') as csvfile:
+        reader = csv.DictReader(csvfile, delimiter=',')
+        for row in reader:
+            key = (row['Owner Source'], row['Owner ID'])
+            owner = owners.get(key)
+            if owner is None:
+                owner = owners[key] = Owner(sys.intern(key[0]), sys.intern(key[1]))
+
+            if bool(row.get('Subscription', '')):
+                migrationData.add_subscription(
+                    SubscriptionMigrationData(sys.intern(row['Topic']), row['Subscription'], owner)
+                )
+            else:
+                migrationData.add_topic(
+                    TopicMigrationData(sys.intern(row['Topic']), owner)
+                )
+
+            rows += 1
+            if rows == chunk_size:
+                yield migrationData
+                migrationData = MigrationData()
+                rows = 0
+    if rows:
+        yield migrationData
+
+
+def current_owner(entity):
+    return entity.get('owner', UNKNOWN_OWNER)
+
+
+def has_owner(entity, owner: Owner):
+    current = current_owner(entity)
+    return current['source'] == owner.source and current['id'] == owner.id
+
+
+def owner_fix(owner: Owner):
+    def fix(data):
+        entity = codec.extract(data, ('owner',))
+        if has_owner(entity, owner):
+            return None
+        changed = dict(current_owner(entity))
+        changed['source'] = owner.source
+        changed['id'] = owner.id
+        return codec.patch(data, {'owner': changed})
+    return fix
+
+
+class OwnerMigrator(Visitor):
+
+    """Changes owners of topics and subscriptions listed in MigrationData."""
+
+    def __init__(self, migration_data: MigrationData, writer, dryrun):
+        # may be replaced between walks when the CSV file is processed in chunks
+        self.migration_data = migration_data
+        self.writer = writer
+        self.dryrun = dryrun
+        self.counter = 0
+
+    def wants_topic(self, group, topic):
+        topicAndSub = self.migration_data.find_topic("{}.{}".format(group, topic))
+        if topicAndSub:
+            report.finding('csv-topic', "Found topic: {}.{} in CSV data".format(group, topic), report.VERBOSE,
+                           topic="{}.{}".format(group, topic))
+        return bool(topicAndSub and topicAndSub.topic)
+
+    def wants_subscriptions(self, group, topic):
+        topicAndSub = self.migration_data.find_topic("{}.{}".format(group, topic))
+        return bool(topicAndSub and topicAndSub.has_subscriptions())
+
+    def wants_subscription(self, group, topic, subscription):
+        topicAndSub = self.migration_data.find_topic("{}.{}".format(group, topic))
+        return topicAndSub.subscription("{}.{}${}".format(group, topic, subscription)) is not None
+
+    def visit_topic(self, node):
+        fields = node.fields('owner')
+        if fields is None:
+            report.finding('unreadable-topic', "Unable to read topic data: {}".format(node.topic_name),
+                           topic=node.topic_name)
+            return
+        owner = self.migration_data.find_topic(node.topic_name).topic.owner
+        self.change_owner("topic", node, fields, owner)
+
+    def visit_subscription(self, node):
+        fields = node.fields('owner')
+        if fields is None:
+            report.finding('unreadable-subscription', "Unable to read sub data: {}".format(node.qualified_name),
+                           subscription=node.qualified_name)
+            return
+        owner = self.migration_data.find_topic(node.topic_name).subscription(node.qualified_name).owner
+        self.change_owner("sub", node, fields, owner)
+
+    def change_owner(self, kind, node, fields, owner):
+        if has_owner(fields, owner):
+            return
+
+        previous = current_owner(fields)['id']
+        report.finding('owner-change', "Changing owner of {}: {} from: {} to: {} {}".format(
+            kind, node.qualified_name, previous, owner.source, owner.id
+        ), entity=kind, name=node.qualified_name, previous=previous, source=owner.source, owner=owner.id)
+        self.counter = self.counter + 1
+
+        if not self.dryrun:
+            self.writer.update(node.path, node.raw, node.stat.version, owner_fix(owner))
+
+    def state(self):
+        return self.counter
+
+    def merge(self, state):
+        self.counter += state
+
+    def finish(self):
+        click.echo("Changed owner for {} topics & subs".format(self.counter))
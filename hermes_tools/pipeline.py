@@ -0,0 +1,48 @@
+from collections import deque
+
+from kazoo.exceptions import NoNodeError
+
+
+class Pipeline:
+
+    """Keeps up to `concurrency` asynchronous ZooKeeper requests in flight.
+
+    Requests are issued with kazoo's *_async calls and their results are handed
+    to callbacks in submission order, on the calling thread. Callbacks may submit
+    further requests, which is how a tree walk fans out without ever exceeding
+    the window. Nodes removed between listing and fetching are skipped, or
+    handed to the `missing` callback when one is given.
+    """
+
+    def __init__(self, zk, concurrency):
+        self.zk = zk
+        self.concurrency = max(1, concurrency)
+        self.waiting = deque()
+        self.in_flight = deque()
+
+    def submit(self, start, path, callback, missing=None):
+        self.waiting.append((start, path, callback, missing))
+
+    def get(self, path, callback, watch=None, missing=None):
+        self.submit(lambda: self.zk.get_async(path, watch=watch), path, callback, missing)
+
+    def get_children(self, path, callback, watch=None, missing=None):
+        self.submit(lambda: self.zk.get_children_async(path, watch=watch), path, callback, missing)
+
+    def exists(self, path, callback, watch=None):
+        self.submit(lambda: self.zk.exists_async(path, watch=watch), path, callback)
+
+    def run(self):
+        while self.waiting or self.in_flight:
+            while self.waiting and len(self.in_flight) < self.concurrency:
+                start, path, callback, missing = self.waiting.popleft()
+                self.in_flight.append((start(), path, callback, missing))
+
+            result, path, callback, missing = self.in_flight.popleft()
+            try:
+                value = result.get()
+            except NoNodeError:
+                if missing:
+                    missing(path)
+                continue
+            callback(path, value)
@@ -0,0 +1,148 @@
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+from collections import Counter
+
+import click
+
+SUMMARY, CHANGES, VERBOSE = LEVELS = ('summary', 'changes', 'verbose')
+
+STOP = object()
+
+
+def open_text(filename, mode):
+    """Opens a text file, gzip-compressed when its name ends with .gz."""
+    if not filename.endswith('.gz'):
+        return open(filename, mode, encoding='utf-8')
+    if 'w' in mode:
+        # no timestamp in the header, so that reports of identical runs are identical
+        return io.TextIOWrapper(gzip.GzipFile(filename, 'wb', mtime=0), encoding='utf-8')
+    return gzip.open(filename, 'rt', encoding='utf-8')
+
+
+class BackgroundWriter:
+
+    """Writes JSON Lines from a thread of its own, so that a finding costs the caller only a queue put."""
+
+    def __init__(self, filename):
+        self.file = open_text(filename, 'w')
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='report-writer', daemon=True)
+        self.thread.start()
+
+    def put(self, entry):
+        """Queues a dict, or an already encoded line."""
+        self.queue.put(entry)
+
+    def run(self):
+        while True:
+            entries = [self.queue.get()]
+            while len(entries) < 1000 and not self.queue.empty():
+                entries.append(self.queue.get())
+            for entry in entries:
+                if entry is STOP:
+                    self.file.close()
+                    return
+                self.file.write(entry if isinstance(entry, str) else json.dumps(entry, sort_keys=True) + "\n")
+            if self.queue.empty():
+                # idle, let a long running --watch be followed with tail -f
+                self.file.flush()
+
+    def close(self):
+        self.queue.put(STOP)
+        self.thread.join()
+
+
+class Report:
+
+    """Findings of a run - listed nodes, changes made or proposed, problems - counted per kind.
+
+    A finding at or below `level` is written to `filename` as a JSON line of
+    its kind and fields, or echoed as text when there is no file. Lines carry
+    no timestamps or numbering, so reports of two dry runs can be diffed.
+    With a file, only the counters are printed on the terminal, at the end.
+    Findings of a run against several clusters carry the `cluster` name.
+    """
+
+    def __init__(self, filename=None, level=VERBOSE, cluster=None):
+        self.filename = filename
+        self.level = LEVELS.index(level)
+        self.cluster = cluster
+        self.lock = threading.Lock()
+        self.counter = Counter()
+        self.writer = BackgroundWriter(filename) if filename else None
+
+    def add(self, kind, text, level=CHANGES, **fields):
+        with self.lock:
+            self.counter[kind] += 1
+        if LEVELS.index(level) > self.level:
+            return
+        if self.writer is None:
+            click.echo(text)
+        else:
+            fields['kind'] = kind
+            if self.cluster:
+                fields['cluster'] = self.cluster
+            self.writer.put(fields)
+
+    def part(self, index, cluster=None):
+        """Arguments of configure() for a worker process writing its share of the report, merged back with include()."""
+        cluster = cluster or self.cluster
+        if self.filename is None:
+            return None, LEVELS[self.level], cluster
+        base, extension = self.filename[:-3], '.gz' if self.filename.endswith('.gz') else ''
+        if not extension:
+            base = self.filename
+        return "{}.part{}{}".format(base, index, extension), LEVELS[self.level], cluster
+
+    def include(self, filename, counters, cluster=None, status=None):
+        """Adds a part of the report and its counters, followed by a line of the totals of `cluster`, when given."""
+        self.add_counters(counters)
+        if filename is None:
+            return
+        # a worker that failed early may have left no part
+        if os.path.exists(filename):
+            with open_text(filename, 'r') as f:
+                for line in f:
+                    self.writer.put(line)
+            os.remove(filename)
+        if cluster:
+            self.writer.put({'kind': 'cluster-totals', 'cluster': cluster, 'findings': counters, 'status': status})
+
+    def counters(self):
+        return dict(self.counter)
+
+    def add_counters(self, counters):
+        with self.lock:
+            self.counter.update(counters)
+
+    def summary(self):
+        if not self.counter:
+            return "  none"
+        return "\n".join("{:>10}  {}".format(count, kind) for kind, count in sorted(self.counter.items()))
+
+    def close(self, summary=True):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+            if summary:
+                click.echo("\nFindings written to {}:\n{}".format(self.filename, self.summary()))
+        elif summary and self.level < LEVELS.index(VERBOSE) and self.counter:
+            click.echo("\nFindings:\n{}".format(self.summary()))
+
+
+current = Report()
+
+
+def configure(filename=None, level=VERBOSE, cluster=None):
+    """Replaces the report findings of this process go to, and returns it."""
+    global current
+    current = Report(filename, level, cluster)
+    return current
+
+
+def finding(kind, text, level=CHANGES, **fields):
+    current.add(kind, text, level, **fields)
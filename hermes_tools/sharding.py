@@ -0,0 +1,104 @@
+import heapq
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from hermes_tools import report
+from hermes_tools.pipeline import Pipeline
+from hermes_tools.traversal import TraversalEngine
+from hermes_tools.writes import BatchWriter
+
+SHARD_BY = ('hash', 'size')
+
+
+def shard_by_hash(groups, shards):
+    """Rendezvous hashing: a group stays in its shard across runs, and only 1/N of groups move when N changes."""
+    assignment = [[] for _ in range(shards)]
+    for group in groups:
+        shard = max(range(shards), key=lambda i: zlib.crc32("{}/{}".format(i, group).encode("utf-8")))
+        assignment[shard].append(group)
+    return assignment
+
+
+def shard_by_size(zk, prefix, groups, shards, concurrency=64):
+    """Balances the number of topics per shard, largest groups first."""
+    sizes = {}
+    pipeline = Pipeline(zk, concurrency)
+    for group in groups:
+        pipeline.exists(
+            "{}/groups/{}/topics".format(prefix, group),
+            lambda p, stat, group=group: sizes.__setitem__(group, stat.numChildren if stat else 0)
+        )
+    pipeline.run()
+
+    assignment = [[] for _ in range(shards)]
+    load = [(0, i) for i in range(shards)]
+    for group in sorted(groups, key=lambda g: -sizes.get(g, 0)):
+        size, shard = heapq.heappop(load)
+        assignment[shard].append(group)
+        heapq.heappush(load, (size + max(1, sizes.get(group, 0)), shard))
+    return assignment
+
+
+def worker_pool(workers):
+    """Returns a pool of `workers` processes started afresh rather than forked.
+
+    kazoo runs threads in this process, which forked workers would inherit in
+    an undefined state.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def walk_shard(connect, prefix, groups, create_visitors, args, concurrency, batch_size, report_part):
+    """Runs in a worker process, with its own ZooKeeper session and its own part of the report."""
+    zk = connect()
+    shard_report = report.configure(*report_part)
+    try:
+        writer = BatchWriter(zk, batch_size)
+        visitors = create_visitors(writer, *args)
+        TraversalEngine(zk, prefix, visitors, concurrency, groups).walk()
+        writer.flush()
+        return writer.counters(), [visitor.state() for visitor in visitors], shard_report.counters()
+    finally:
+        shard_report.close(summary=False)
+        zk.stop()
+        zk.close()
+
+
+def traverse_sharded(zk, prefix, writer, create_visitors, args, connect, processes, shard_by='hash', concurrency=1):
+    """Walks the tree in `processes` worker processes, each taking a share of the groups.
+
+    The coordinator only lists /groups with `zk`. Every worker opens its own
+    session with `connect`, a picklable callable returning a client, builds
+    its visitors with `create_visitors(writer, *args)` and writes through its
+    own BatchWriter. Counters of the writers and states of the visitors are
+    merged into `writer`, if any, and into visitors built here, which are then
+    finished and returned. Workers write findings to parts of the report,
+    appended to it in shard order.
+    """
+    groups = zk.get_children("{}/groups".format(prefix))
+    if shard_by == 'size':
+        shards = shard_by_size(zk, prefix, groups, processes)
+    else:
+        shards = shard_by_hash(groups, processes)
+
+    visitors = create_visitors(writer, *args)
+    batch_size = writer.batch_size if writer else 1
+    with worker_pool(processes) as executor:
+        parts = [report.current.part(index) for index in range(len(shards))]
+        futures = [
+            (executor.submit(walk_shard, connect, prefix, shard, create_visitors, args, concurrency, batch_size, part),
+             part)
+            for shard, part in zip(shards, parts) if shard
+        ]
+        for future, (filename, level, cluster) in futures:
+            counters, states, findings = future.result()
+            if writer:
+                writer.add_counters(counters)
+            report.current.include(filename, findings)
+            for visitor, state in zip(visitors, states):
+                visitor.merge(state)
+
+    for visitor in visitors:
+        visitor.finish()
+    return visitors
@@ -0,0 +1,260 @@
+import json
+import mmap
+import os
+import struct
+from datetime import datetime, timezone
+
+import click
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import ZnodeStat
+
+from hermes_tools.pipeline import Pipeline
+
+MAGIC = b"HZKSNAP1"
+# payload offset, payload length, mzxid, pzxid, version, cversion, path length
+ENTRY = struct.Struct("<QIqqiiH")
+# index offset, number of entries, metadata offset, metadata length
+FOOTER = struct.Struct("<QIQI")
+
+# Parts of the tree below the prefix that the scripts read, '*' matches any child.
+LAYOUT = {
+    'groups': {'*': {'topics': {'*': {'subscriptions': {'*': {}}}}}},
+    'consumers-rate': {'runtime': {'*': {'*': {}}}},
+    'consumers-workload': {'*': {'registry': {'nodes': {'*': {}}}}},
+}
+
+
+class SnapshotEntry:
+    __slots__ = ('data', 'mzxid', 'pzxid', 'version', 'cversion')
+
+    def __init__(self, data, mzxid, pzxid, version, cversion):
+        self.data = data
+        self.mzxid = mzxid
+        self.pzxid = pzxid
+        self.version = version
+        self.cversion = cversion
+
+
+class ResolvedResult:
+
+    """Already available result, quacks like kazoo's IAsyncResult for Pipeline."""
+
+    def __init__(self, call, *args):
+        try:
+            self.value = call(*args)
+            self.exception = None
+        except NoNodeError as e:
+            self.value = None
+            self.exception = e
+
+    def get(self, block=True, timeout=None):
+        if self.exception:
+            raise self.exception
+        return self.value
+
+
+class Snapshot:
+
+    """Read-only, memory-mapped view of a snapshot file.
+
+    Offers the read calls of KazooClient the scripts use, so a snapshot can be
+    walked in place of a live ensemble. Payloads stay in the mapped file until
+    they are requested.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a Hermes ZooKeeper snapshot".format(filename))
+
+        index_offset, count, metadata_offset, metadata_length = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        self.metadata = json.loads(self.mm[metadata_offset:metadata_offset + metadata_length])
+
+        self.entries = {}
+        self.children = {}
+        offset = index_offset
+        for _ in range(count):
+            payload_offset, length, mzxid, pzxid, version, cversion, path_length = ENTRY.unpack_from(self.mm, offset)
+            offset += ENTRY.size
+            path = self.mm[offset:offset + path_length].decode("utf-8")
+            offset += path_length
+            self.entries[path] = (payload_offset, length, mzxid, pzxid, version, cversion)
+            self.children[path] = []
+            parent, _, name = path.rpartition('/')
+            if parent in self.children:
+                self.children[parent].append(name)
+
+    @property
+    def prefix(self):
+        return self.metadata['prefix']
+
+    def entry(self, path):
+        offset, length, mzxid, pzxid, version, cversion = self.entries[path]
+        return SnapshotEntry(self.mm[offset:offset + length], mzxid, pzxid, version, cversion)
+
+    def _lookup(self, path):
+        path = path.rstrip('/') or '/'
+        if path not in self.entries:
+            raise NoNodeError(path)
+        return path, self.entries[path]
+
+    def _stat(self, path, entry):
+        offset, length, mzxid, pzxid, version, cversion = entry
+        return ZnodeStat(0, mzxid, 0, 0, version, cversion, 0, 0, length, len(self.children[path]), pzxid)
+
+    def get(self, path, watch=None):
+        path, entry = self._lookup(path)
+        return self.mm[entry[0]:entry[0] + entry[1]], self._stat(path, entry)
+
+    def get_children(self, path, watch=None, include_data=False):
+        path, entry = self._lookup(path)
+        if include_data:
+            return list(self.children[path]), self._stat(path, entry)
+        return list(self.children[path])
+
+    def exists(self, path, watch=None):
+        try:
+            path, entry = self._lookup(path)
+        except NoNodeError:
+            return None
+        return self._stat(path, entry)
+
+    def get_async(self, path, watch=None):
+        return ResolvedResult(self.get, path)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return ResolvedResult(self.get_children, path, None, include_data)
+
+    def exists_async(self, path, watch=None):
+        return ResolvedResult(self.exists, path)
+
+    def stop(self):
+        self.close()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+def open_snapshot(filename, prefix):
+    snapshot = Snapshot(filename)
+    if snapshot.prefix != prefix:
+        snapshot.close()
+        raise click.BadParameter(
+            "snapshot was taken with prefix {}, not {}".format(snapshot.prefix, prefix), param_hint="'--from-snapshot'"
+        )
+    return snapshot
+
+
+class SnapshotBuilder:
+
+    """Downloads the tree described by LAYOUT, reusing an older snapshot if given.
+
+    Nodes of the older snapshot are only checked with `exists`: the payload is
+    fetched again only when mzxid moved, and children are listed again only when
+    pzxid moved. Nodes missing from the older snapshot are fetched in full.
+    """
+
+    def __init__(self, zk, prefix, previous=None, concurrency=64):
+        self.zk = zk
+        self.prefix = prefix
+        self.previous = previous
+        self.pipeline = Pipeline(zk, concurrency)
+        self.nodes = {}
+        self.fetched = 0
+        self.reused = 0
+
+    def build(self):
+        self.visit(self.prefix, LAYOUT)
+        self.pipeline.run()
+        return self.nodes
+
+    def visit(self, path, layout):
+        if self.previous and path in self.previous.entries:
+            old = self.previous.entry(path)
+            self.pipeline.exists(path, lambda p, stat: self.on_stat(p, layout, old, stat))
+        else:
+            self.pipeline.get(path, lambda p, result: self.on_data(p, layout, None, *result))
+
+    def on_stat(self, path, layout, old, stat):
+        if stat is None:
+            return
+        if stat.mzxid != old.mzxid:
+            self.pipeline.get(path, lambda p, result: self.on_data(p, layout, old, *result))
+        else:
+            self.reused += 1
+            self.store(path, old.data, stat)
+            self.visit_children(path, layout, old, stat)
+
+    def on_data(self, path, layout, old, data, stat):
+        self.fetched += 1
+        self.store(path, data, stat)
+        self.visit_children(path, layout, old, stat)
+
+    def store(self, path, data, stat):
+        self.nodes[path] = SnapshotEntry(data or b"", stat.mzxid, stat.pzxid, stat.version, stat.cversion)
+
+    def visit_children(self, path, layout, old, stat):
+        if not layout:
+            return
+        if old and stat.pzxid == old.pzxid:
+            self.on_children(path, layout, self.previous.children[path])
+        else:
+            self.pipeline.get_children(path, lambda p, children: self.on_children(p, layout, children))
+
+    def on_children(self, path, layout, children):
+        for child in children:
+            if child in layout:
+                self.visit("{}/{}".format(path, child), layout[child])
+            elif '*' in layout:
+                self.visit("{}/{}".format(path, child), layout['*'])
+
+
+def write_snapshot(filename, nodes, metadata):
+    tmp = "{}.tmp".format(filename)
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        paths = sorted(nodes)
+        offsets = {}
+        for path in paths:
+            offsets[path] = f.tell()
+            f.write(nodes[path].data)
+
+        index_offset = f.tell()
+        for path in paths:
+            node = nodes[path]
+            encoded = path.encode("utf-8")
+            f.write(ENTRY.pack(offsets[path], len(node.data), node.mzxid, node.pzxid, node.version, node.cversion, len(encoded)))
+            f.write(encoded)
+
+        metadata_offset = f.tell()
+        encoded = json.dumps(metadata).encode("utf-8")
+        f.write(encoded)
+        f.write(FOOTER.pack(index_offset, len(nodes), metadata_offset, len(encoded)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def take_snapshot(zk, zookeeper, prefix, filename, concurrency, incremental=True):
+    previous = None
+    if incremental and os.path.exists(filename):
+        previous = Snapshot(filename)
+        if previous.prefix != prefix:
+            raise click.BadParameter(
+                "{} was taken with prefix {}, not {}".format(filename, previous.prefix, prefix), param_hint="'--output'"
+            )
+
+    builder = SnapshotBuilder(zk, prefix, previous, concurrency)
+    try:
+        nodes = builder.build()
+        write_snapshot(filename, nodes, {
+            'prefix': prefix,
+            'zookeeper': zookeeper,
+            'created': datetime.now(timezone.utc).isoformat(),
+        })
+    finally:
+        if previous:
+            previous.close()
+    return builder
@@ -0,0 +1,86 @@
+import heapq
+import os
+import tempfile
+
+# names held in memory by ExternalSort before a sorted run is spilled to disk
+DEFAULT_LIMIT = 100000
+
+END = object()
+
+
+class ExternalSort:
+
+    """Collects names and iterates them sorted, holding at most `limit` of them in memory.
+
+    Above the limit the collected names are sorted and spilled to a file, and
+    iteration merges those runs with the names still in memory. It can be
+    iterated any number of times. Names must not contain newlines; pairs can
+    be joined with a tab, which sorts before any character of a Hermes or
+    ZooKeeper name, so that they sort by their first name.
+    """
+
+    def __init__(self, names=(), limit=DEFAULT_LIMIT):
+        self.limit = max(1, limit)
+        self.buffer = []
+        self.runs = []
+        self.directory = None
+        self.count = 0
+        self.extend(names)
+
+    def append(self, name):
+        self.buffer.append(name)
+        self.count += 1
+        if len(self.buffer) >= self.limit:
+            self.spill()
+
+    def extend(self, names):
+        for name in names:
+            self.append(name)
+
+    def spill(self):
+        if self.directory is None:
+            # removed with the object, when it isn't closed
+            self.directory = tempfile.TemporaryDirectory(prefix='hermes-sort-')
+        filename = os.path.join(self.directory.name, "run{}".format(len(self.runs)))
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.writelines(name + "\n" for name in sorted(self.buffer))
+        self.runs.append(filename)
+        self.buffer = []
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.buffer.sort()
+        if not self.runs:
+            return iter(list(self.buffer))
+        return heapq.merge(*[read_run(run) for run in self.runs], list(self.buffer))
+
+    def close(self):
+        if self.directory is not None:
+            self.directory.cleanup()
+            self.directory = None
+        self.runs = []
+        self.buffer = []
+
+
+def read_run(filename):
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            yield line[:-1]
+
+
+def missing(names, present, key=None):
+    """Yields names of the sorted stream `names` whose key is not in the sorted stream `present`.
+
+    A merge-join, both streams are read once. `key` picks the part of a name
+    that `present` is sorted by and that `names` are sorted by first.
+    """
+    present = iter(present)
+    current = next(present, END)
+    for name in names:
+        wanted = key(name) if key else name
+        while current is not END and current < wanted:
+            current = next(present, END)
+        if current is END or current != wanted:
+            yield name
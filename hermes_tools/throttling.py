@@ -0,0 +1,105 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+
+
+class TokenBucket:
+
+    """Lets through `rate` operations per second on average, with bursts of up to `burst` operations."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, latency):
+        pass
+
+    @contextmanager
+    def operation(self):
+        self.wait()
+        started = time.monotonic()
+        yield
+        self.observe(time.monotonic() - started)
+
+
+class AdaptiveThrottle(TokenBucket):
+
+    """Token bucket whose rate follows the health of the ensemble.
+
+    The rate grows by `step` ops/sec after every operation that completes below
+    `target_latency`, and is halved when an operation takes longer or when the
+    ensemble reports more than `max_outstanding` outstanding requests.
+    Outstanding requests and server latency come from the `mntr` four letter
+    word, sampled every `sample_interval` seconds; if the server does not allow
+    `mntr`, only the latency observed by this client is used.
+    """
+
+    def __init__(self, zk, rate, min_rate, max_rate, target_latency, max_outstanding=10, step=0.5, sample_interval=5.0):
+        super().__init__(rate)
+        self.zk = zk
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.max_outstanding = max_outstanding
+        self.step = step
+        self.sample_interval = sample_interval
+        self.sampled = 0
+        self.server_stats = True
+
+    def observe(self, latency):
+        overloaded = latency > self.target_latency or self.server_overloaded()
+        with self.lock:
+            previous = self.rate
+            if overloaded:
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.step)
+        if overloaded and self.rate != previous:
+            click.echo(" Backing off to {:.1f} ops/s".format(self.rate))
+
+    def server_overloaded(self):
+        if not self.server_stats or time.monotonic() - self.sampled < self.sample_interval:
+            return False
+        self.sampled = time.monotonic()
+        try:
+            stats = parse_mntr(self.zk.command(b'mntr'))
+        except Exception:
+            # mntr not whitelisted or not supported by this client
+            self.server_stats = False
+            return False
+        return (stats.get('zk_outstanding_requests', 0) > self.max_outstanding
+                or stats.get('zk_avg_latency', 0) > self.target_latency * 1000)
+
+
+def parse_mntr(output):
+    stats = {}
+    for line in output.splitlines():
+        key, _, value = line.partition('\t')
+        try:
+            stats[key] = float(value)
+        except ValueError:
+            pass
+    return stats
+
+
+def create_throttle(zk, ops_per_second, adaptive=False, max_ops_per_second=50.0, target_latency=0.1):
+    if adaptive:
+        return AdaptiveThrottle(
+            zk, ops_per_second, min_rate=min(ops_per_second, 0.5), max_rate=max_ops_per_second, target_latency=target_latency
+        )
+    return TokenBucket(ops_per_second)
@@ -0,0 +1,273 @@
+from collections import deque
+from contextlib import nullcontext
+
+import click
+
+from hermes_tools import codec
+from hermes_tools.pipeline import Pipeline
+
+NOT_DECODED = object()
+
+
+class Node:
+
+    """Topic or subscription read from ZooKeeper, shared by all visitors.
+
+    The payload is decoded on first use of `data` or fields(), once for all
+    visitors, and `data` is None when it is not valid JSON. Visitors must not
+    modify it, changes are made by handing a fix function to BatchWriter.
+    """
+
+    __slots__ = ('path', 'group', 'topic', 'name', 'raw', 'stat', 'metrics', '_data')
+
+    def __init__(self, path, group, topic, name, raw, stat, metrics=None):
+        self.path = path
+        self.group = group
+        self.topic = topic
+        self.name = name
+        self.raw = raw
+        self.stat = stat
+        self.metrics = metrics
+        self._data = NOT_DECODED
+
+    def timer(self):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.timer('json', 'parse', len(self.raw))
+
+    @property
+    def data(self):
+        if self._data is NOT_DECODED:
+            with self.timer():
+                try:
+                    self._data = codec.loads(self.raw)
+                except ValueError:
+                    self._data = None
+        return self._data
+
+    def fields(self, *keys):
+        """Returns a dict of those top-level `keys` the payload has, or None when it is not valid JSON."""
+        data = self.data
+        if not isinstance(data, dict):
+            return None
+        return {key: data[key] for key in keys if key in data}
+
+    @property
+    def topic_name(self):
+        return "{}.{}".format(self.group, self.topic)
+
+    @property
+    def qualified_name(self):
+        if self.name is None:
+            return self.topic_name
+        return "{}${}".format(self.topic_name, self.name)
+
+
+class Visitor:
+
+    """Fixer or collector plugged into TraversalEngine.
+
+    The want_* hooks decide which nodes are fetched at all: a topic payload is
+    downloaded only if some visitor wants it, and so are subscription lists and
+    subscription payloads.
+    """
+
+    def wants_topic(self, group, topic):
+        return False
+
+    def wants_subscriptions(self, group, topic):
+        return False
+
+    def wants_subscription(self, group, topic, subscription):
+        return True
+
+    def visit_topic(self, node):
+        pass
+
+    def visit_subscription(self, node):
+        pass
+
+    def finish(self):
+        pass
+
+    def state(self):
+        """Results of a walk over part of the tree, merged into another visitor with merge()."""
+        return None
+
+    def merge(self, state):
+        pass
+
+
+class TraversalEngine:
+
+    """Walks /groups/*/topics/*/subscriptions/* once and dispatches every node to all interested visitors.
+
+    With `groups`, only those groups are walked and /groups is not listed.
+    `on_group` is called with the name of every group once all of its nodes
+    have been visited.
+    """
+
+    def __init__(self, zk, prefix, visitors, concurrency=1, groups=None, on_group=None):
+        self.zk = zk
+        self.prefix = prefix
+        self.visitors = visitors
+        self.groups = groups
+        self.on_group = on_group
+        self.unvisited = deque()
+        self.outstanding = {}
+        self.pipeline = Pipeline(zk, concurrency)
+        # set when zk is an InstrumentedZooKeeper, decoding time of nodes is then recorded too
+        self.metrics = getattr(zk, 'metrics', None)
+
+    def run(self):
+        self.walk()
+        for visitor in self.visitors:
+            visitor.finish()
+
+    def walk(self):
+        if self.groups is None:
+            self.pipeline.get_children("{}/groups".format(self.prefix), self.on_groups)
+        else:
+            self.on_groups("{}/groups".format(self.prefix), self.groups)
+        self.pipeline.run()
+
+    def on_groups(self, path, groups):
+        self.unvisited = deque(groups)
+        # the walk is breadth-first, with on_group only a few groups are open at a time so that they finish steadily
+        opened = len(groups) if self.on_group is None else self.pipeline.concurrency
+        for _ in range(opened):
+            self.next_group()
+
+    def next_group(self):
+        if self.unvisited:
+            group = self.unvisited.popleft()
+            self.request(
+                self.pipeline.get_children, group, "{}/groups/{}/topics".format(self.prefix, group),
+                lambda p, topics, group=group: self.on_topics(p, group, topics)
+            )
+
+    def request(self, method, group, path, callback):
+        """Makes a pipelined request for a node of `group`, counting requests of every group when on_group is set."""
+        if self.on_group is None:
+            method(path, callback)
+            return
+
+        self.outstanding[group] = self.outstanding.get(group, 0) + 1
+
+        def finished(p):
+            self.outstanding[group] -= 1
+            if self.outstanding[group] == 0:
+                del self.outstanding[group]
+                self.on_group(group)
+                self.next_group()
+
+        def on_result(p, result):
+            # requests made by the callback are counted before this one is done
+            callback(p, result)
+            finished(p)
+
+        method(path, on_result, missing=finished)
+
+    def on_topics(self, path, group, topics):
+        for topic in topics:
+            topic_path = "{}/{}".format(path, topic)
+
+            visitors = [v for v in self.visitors if v.wants_topic(group, topic)]
+            if visitors:
+                self.request(
+                    self.pipeline.get, group, topic_path,
+                    lambda p, result, topic=topic, visitors=visitors: self.on_topic(p, group, topic, visitors, *result)
+                )
+
+            visitors = [v for v in self.visitors if v.wants_subscriptions(group, topic)]
+            if visitors:
+                self.request(
+                    self.pipeline.get_children, group, "{}/subscriptions".format(topic_path),
+                    lambda p, subscriptions, topic=topic, visitors=visitors:
+                        self.on_subscriptions(p, group, topic, subscriptions, visitors)
+                )
+
+    def node(self, path, group, topic, name, data, stat):
+        return Node(path, group, topic, name, data, stat, self.metrics)
+
+    def on_topic(self, path, group, topic, visitors, data, stat):
+        node = self.node(path, group, topic, None, data, stat)
+        for visitor in visitors:
+            visitor.visit_topic(node)
+
+    def on_subscriptions(self, path, group, topic, subscriptions, visitors):
+        for subscription in subscriptions:
+            interested = [v for v in visitors if v.wants_subscription(group, topic, subscription)]
+            if interested:
+                self.request(
+                    self.pipeline.get, group, "{}/{}".format(path, subscription),
+                    lambda p, result, subscription=subscription, interested=interested:
+                        self.on_subscription(p, group, topic, subscription, interested, *result)
+                )
+
+    def on_subscription(self, path, group, topic, subscription, visitors, data, stat):
+        node = self.node(path, group, topic, subscription, data, stat)
+        for visitor in visitors:
+            visitor.visit_subscription(node)
+
+
+class DirectTraversal(TraversalEngine):
+
+    """Fetches only the topics and subscriptions named in `targets` instead of walking the whole tree.
+
+    `targets` yields (qualified topic name, subscription names) pairs. A topic
+    name is split into group and topic at the last dot, like Hermes does. Only
+    when no such topic exists, /groups is listed once to look for another group
+    the name could belong to.
+    """
+
+    def __init__(self, zk, prefix, visitors, targets, concurrency=1):
+        super().__init__(zk, prefix, visitors, concurrency)
+        self.targets = targets
+        self.group_names = None
+        self.unresolved = []
+
+    def walk(self):
+        for qualified_name, subscriptions in self.targets:
+            group, _, topic = qualified_name.rpartition('.')
+            self.locate(qualified_name, group, topic, subscriptions, {group})
+        self.pipeline.run()
+
+    def locate(self, qualified_name, group, topic, subscriptions, tried):
+        # the topic is read right away, a missing one is one round trip just like checking it exists
+        self.pipeline.get(
+            "{}/groups/{}/topics/{}".format(self.prefix, group, topic),
+            lambda p, result: self.on_located(p, group, topic, subscriptions, *result),
+            missing=lambda p: self.on_missing(qualified_name, subscriptions, tried)
+        )
+
+    def on_missing(self, qualified_name, subscriptions, tried):
+        if self.group_names is None:
+            self.unresolved.append((qualified_name, subscriptions, tried))
+            if len(self.unresolved) == 1:
+                self.pipeline.get_children("{}/groups".format(self.prefix), self.on_group_names)
+            return
+
+        candidates = [g for g in self.group_names if qualified_name.startswith(g + '.') and g not in tried]
+        if not candidates:
+            click.echo("Topic not found: {}".format(qualified_name))
+            return
+
+        # prefer the longest group name, Hermes splits at the last dot
+        group = max(candidates, key=len)
+        self.locate(qualified_name, group, qualified_name[len(group) + 1:], subscriptions, tried | {group})
+
+    def on_group_names(self, path, groups):
+        self.group_names = set(groups)
+        for unresolved in self.unresolved:
+            self.on_missing(*unresolved)
+        self.unresolved = []
+
+    def on_located(self, path, group, topic, subscriptions, data, stat):
+        visitors = [v for v in self.visitors if v.wants_topic(group, topic)]
+        if visitors:
+            self.on_topic(path, group, topic, visitors, data, stat)
+
+        visitors = [v for v in self.visitors if v.wants_subscriptions(group, topic)]
+        if visitors:
+            self.on_subscriptions("{}/subscriptions".format(path), group, topic, subscriptions, visitors)
@@ -0,0 +1,210 @@
+import json
+
+import click
+from kazoo.exceptions import RolledBackError, RuntimeInconsistency
+
+from hermes_tools import report
+from hermes_tools.pipeline import Pipeline
+
+
+class Entity:
+    __slots__ = ('data', 'version', 'topics')
+
+    def __init__(self):
+        self.data = None
+        self.version = None
+        self.topics = {}
+
+
+class Change:
+    __slots__ = ('text', 'operations')
+
+    def __init__(self, text, operations):
+        self.text = text
+        self.operations = operations
+
+
+def decode(data):
+    try:
+        return json.loads(data)
+    except (TypeError, ValueError):
+        return None
+
+
+def encode(payload):
+    return json.dumps(payload).encode("utf-8")
+
+
+class TreeCopier:
+
+    """Copies groups and topics from one Hermes ZooKeeper tree to another, bypassing Hermes Management.
+
+    Both trees are read with pipelined requests and source payloads are passed
+    through `sanitize_group` / `sanitize_topic`. Like hermes-migrator does over
+    REST, missing groups and topics are created - together with their `topics`
+    / `subscriptions` node - existing groups are updated when their payload
+    differs, and corrupted entities, whose payload isn't valid JSON, get the
+    source payload. Changes are committed in multi transactions of about
+    `batch_size` operations, `concurrency` of them in flight. Transactions of
+    one session are applied in order, so a group always exists before its
+    topics are created. A failed transaction is retried one change at a time.
+    """
+
+    def __init__(self, source, source_prefix, destination, destination_prefix, sanitize_group, sanitize_topic,
+                 dryrun, concurrency=64, batch_size=100, progress=None):
+        self.source = source
+        self.source_prefix = source_prefix
+        self.destination = destination
+        self.destination_prefix = destination_prefix
+        self.sanitize_group = sanitize_group
+        self.sanitize_topic = sanitize_topic
+        self.dryrun = dryrun
+        self.concurrency = concurrency
+        self.batch_size = max(1, batch_size)
+        self.progress = progress
+        self.changes = []
+        self.applied = 0
+        self.failed = 0
+
+    def run(self):
+        groups = self.read(self.source, self.source_prefix)
+        click.echo("Read {} groups and {} topics from source".format(
+            len(groups), sum(len(group.topics) for group in groups.values())
+        ))
+        if not self.dryrun:
+            self.destination.ensure_path("{}/groups".format(self.destination_prefix))
+        existing = self.read(self.destination, self.destination_prefix, groups)
+        for name in sorted(groups):
+            self.plan(name, groups[name], existing.get(name))
+        if not self.dryrun:
+            self.apply()
+
+    def read(self, zk, prefix, wanted=None):
+        """Returns groups of the tree with their topics, only those in `wanted` when given."""
+        groups = {}
+        pipeline = Pipeline(zk, self.concurrency)
+
+        def on_data(entity, result):
+            entity.data, stat = result
+            entity.version = stat.version
+
+        def on_groups(path, names):
+            for name in names:
+                if wanted is None or name in wanted:
+                    group = groups[name] = Entity()
+                    pipeline.get("{}/{}".format(path, name), lambda p, result, group=group: on_data(group, result))
+                    pipeline.get_children(
+                        "{}/{}/topics".format(path, name), lambda p, topics, group=group: on_topics(p, group, topics)
+                    )
+
+        def on_topics(path, group, topics):
+            for name in topics:
+                topic = group.topics[name] = Entity()
+                pipeline.get("{}/{}".format(path, name), lambda p, result, topic=topic: on_data(topic, result))
+
+        pipeline.get_children("{}/groups".format(prefix), on_groups)
+        pipeline.run()
+        return groups
+
+    def plan(self, name, group, target):
+        path = "{}/groups/{}".format(self.destination_prefix, name)
+        payload = decode(group.data)
+        if not isinstance(payload, dict):
+            report.finding('unreadable-group', "Unable to read source group: {}".format(name), group=name)
+            return
+
+        sanitized = self.sanitize_group(payload)
+        if target is None:
+            self.change('missing-group', "Creating missing group: {}".format(name), [
+                ('create', path, encode(sanitized)), ('create', "{}/topics".format(path), b"")
+            ], group=name)
+        elif decode(target.data) is None:
+            self.change('corrupted-group', "Replacing corrupted group: {}".format(name), [
+                ('set_data', path, encode(sanitized), target.version)
+            ], group=name)
+        elif decode(target.data) != sanitized:
+            self.change('existing-group', "Patching existing group: {}".format(name), [
+                ('set_data', path, encode(sanitized), target.version)
+            ], group=name)
+
+        for topic_name in sorted(group.topics):
+            topic = group.topics[topic_name]
+            topic_path = "{}/topics/{}".format(path, topic_name)
+            payload = decode(topic.data)
+            if not isinstance(payload, dict):
+                report.finding('unreadable-topic', "Unable to read source topic: {}.{}".format(name, topic_name),
+                               topic="{}.{}".format(name, topic_name))
+                continue
+
+            existing = target.topics.get(topic_name) if target else None
+            if existing is None:
+                self.change('missing-topic', "Creating missing topic: {}.{}".format(name, topic_name), [
+                    ('create', topic_path, encode(self.sanitize_topic(payload))),
+                    ('create', "{}/subscriptions".format(topic_path), b"")
+                ], topic="{}.{}".format(name, topic_name))
+            elif decode(existing.data) is None:
+                self.change('corrupted-topic', "Replacing corrupted topic: {}.{}".format(name, topic_name), [
+                    ('set_data', topic_path, encode(self.sanitize_topic(payload)), existing.version)
+                ], topic="{}.{}".format(name, topic_name))
+
+    def change(self, kind, text, operations, **fields):
+        report.finding(kind, "DRYRUN: {}".format(text) if self.dryrun else text, **fields)
+        self.changes.append(Change(text, operations))
+
+    def batches(self):
+        batch = []
+        size = 0
+        for change in self.changes:
+            if batch and size + len(change.operations) > self.batch_size:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(change)
+            size += len(change.operations)
+        if batch:
+            yield batch
+
+    def transaction(self, changes):
+        transaction = self.destination.transaction()
+        for change in changes:
+            for operation, *args in change.operations:
+                getattr(transaction, operation)(*args)
+        return transaction
+
+    def apply(self):
+        if self.progress:
+            self.progress.stage("Copying groups & topics", len(self.changes))
+        pipeline = Pipeline(self.destination, self.concurrency)
+        for batch in self.batches():
+            pipeline.submit(
+                lambda batch=batch: self.transaction(batch).commit_async(), None,
+                lambda p, results, batch=batch: self.on_commit(batch, results)
+            )
+        pipeline.run()
+
+    def on_commit(self, batch, results):
+        if not any(isinstance(result, Exception) for result in results):
+            self.done(batch)
+            return
+        # one bad change rolls back the whole batch, find it by committing them one by one
+        for change in batch:
+            errors = [
+                r for r in self.transaction([change]).commit()
+                if isinstance(r, Exception) and not isinstance(r, (RolledBackError, RuntimeInconsistency))
+            ]
+            if errors:
+                self.failed += 1
+                report.finding('failed-change', "Unable to apply '{}': {!r}".format(change.text, errors[0]),
+                               change=change.text, error=repr(errors[0]))
+            else:
+                self.done([change])
+
+    def done(self, changes):
+        self.applied += len(changes)
+        if self.progress:
+            self.progress.advance(len(changes))
+
+    def summary(self):
+        if self.dryrun:
+            return "Would apply {} changes".format(len(self.changes))
+        return "Applied {} changes, {} failed".format(self.applied, self.failed)
@@ -0,0 +1,94 @@
+import click
+
+from hermes_tools import codec, report
+from hermes_tools.traversal import Visitor
+
+
+class SupportTeamFixer(Visitor):
+
+    """Sets supportTeam to `undefined` in subscriptions that have none."""
+
+    def __init__(self, writer, dryrun):
+        self.writer = writer
+        self.dryrun = dryrun
+
+    def wants_subscriptions(self, group, topic):
+        return True
+
+    def visit_subscription(self, node):
+        fields = node.fields('supportTeam')
+        if fields is None:
+            report.finding('unreadable-subscription', "Unable to read sub data: {} {}".format(
+                node.topic_name, node.name
+            ), subscription=node.qualified_name)
+        elif 'supportTeam' not in fields:
+            if self.dryrun:
+                report.finding('missing-support-team', "Subscription without supportTeam: {} {}".format(
+                    node.name, node.data
+                ), subscription=node.qualified_name)
+            else:
+                report.finding('missing-support-team', "Fixing subscription without supportTeam: {}".format(
+                    node.name
+                ), subscription=node.qualified_name)
+                self.writer.update(node.path, node.raw, node.stat.version, add_support_team)
+
+
+def add_support_team(data):
+    if 'supportTeam' in codec.extract(data, ('supportTeam',)):
+        return None
+    return codec.patch(data, {'supportTeam': 'undefined'})
+
+
+class ActiveSubscriptionCollector(Visitor):
+
+    """Collects names of active subscriptions as used in the max-rate tree: group.topic$subscription.
+
+    Names are appended to `subscriptions`, a list unless another collection
+    with append() and extend() - like ExternalSort - is given.
+    """
+
+    def __init__(self, subscriptions=None):
+        self.subscriptions = list() if subscriptions is None else subscriptions
+        self.active_count = 0
+        self.not_active_count = 0
+        self.could_not_parse_count = 0
+
+    def wants_subscriptions(self, group, topic):
+        return True
+
+    def visit_subscription(self, node):
+        fields = node.fields('state')
+        if fields is None:
+            self.could_not_parse_count += 1
+            report.finding('unreadable-subscription', "Unable to read sub data: {} {}".format(
+                node.topic_name, node.name
+            ), subscription=node.qualified_name)
+            return
+
+        state = fields['state']
+        if state == 'ACTIVE':
+            self.subscriptions.append(node.qualified_name)
+            self.active_count += 1
+            report.finding('active-subscription', "{}. {}".format(self.active_count, node.qualified_name),
+                           report.VERBOSE, subscription=node.qualified_name)
+        else:
+            self.not_active_count += 1
+            report.finding('inactive-subscription', "   {} is {}".format(node.qualified_name, state),
+                           report.VERBOSE, subscription=node.qualified_name, state=state)
+
+    def state(self):
+        return list(self.subscriptions), self.active_count, self.not_active_count, self.could_not_parse_count
+
+    def merge(self, state):
+        subscriptions, active_count, not_active_count, could_not_parse_count = state
+        self.subscriptions.extend(subscriptions)
+        self.active_count += active_count
+        self.not_active_count += not_active_count
+        self.could_not_parse_count += could_not_parse_count
+
+    def finish(self):
+        click.echo("Found {} active subscriptions".format(self.active_count))
+        if self.not_active_count > 0:
+            click.echo("Found {} not active subscriptions - will clean up if needed".format(self.not_active_count))
+        if self.could_not_parse_count > 0:
+            click.echo("Found {} invalid subscriptions - will clean up if needed".format(self.could_not_parse_count))
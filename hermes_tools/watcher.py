@@ -0,0 +1,163 @@
+import threading
+import time
+
+import click
+from kazoo.protocol.states import EventType, KazooState
+
+from hermes_tools.traversal import TraversalEngine
+
+# depth of a path below {prefix}/groups: groups list, topics list, topic, subscriptions list, subscription
+GROUPS, TOPICS, TOPIC, SUBSCRIPTIONS, SUBSCRIPTION = 0, 2, 3, 4, 5
+
+
+class TreeWatcher(TraversalEngine):
+
+    """Walks the tree once, then keeps watches on it and visits only nodes created or changed since.
+
+    Watches are one-shot and are registered again by the very request that
+    re-reads the node, so no change can slip between a notification and the
+    next watch. Notifications are collected until none arrives for `debounce`
+    seconds (at most ten times that under constant churn) and the collected
+    nodes are then read in one pipelined batch, each of them once. Watches do
+    not survive session expiration, the whole tree is walked again after the
+    client reconnects with a new session.
+    """
+
+    def __init__(self, zk, prefix, visitors, writer, concurrency=1, debounce=1.0):
+        super().__init__(zk, prefix, visitors, concurrency)
+        self.writer = writer
+        self.debounce = debounce
+        self.children = {}
+        self.condition = threading.Condition()
+        self.events = {}
+        self.last_event = 0
+        self.expired = False
+        zk.add_listener(self.on_state)
+
+    def run(self):
+        self.walk()
+        while True:
+            events = self.wait_for_events()
+            if events is None:
+                click.echo("Session expired, walking the whole tree again")
+                self.walk()
+            else:
+                self.handle(events)
+
+    def walk(self):
+        self.children = {}
+        self.list("{}/groups".format(self.prefix))
+        self.pipeline.run()
+        self.writer.flush()
+
+    def parse(self, path):
+        base = "{}/groups".format(self.prefix)
+        if path == base:
+            return []
+        if not path.startswith(base + '/'):
+            return None
+        return path[len(base) + 1:].split('/')
+
+    # called on kazoo's event thread, requests can't be made here
+    def watch(self, event):
+        if event.type == EventType.NONE:
+            return
+        with self.condition:
+            self.events.setdefault(event.path, set()).add(event.type)
+            self.last_event = time.monotonic()
+            self.condition.notify()
+
+    def on_state(self, state):
+        if state == KazooState.LOST:
+            with self.condition:
+                self.expired = True
+                self.condition.notify()
+
+    def wait_for_events(self):
+        """Returns changed paths with their event types, or None when the session has expired."""
+        with self.condition:
+            while not self.events and not self.expired:
+                self.condition.wait()
+            deadline = time.monotonic() + self.debounce * 10
+            while not self.expired:
+                remaining = min(self.last_event + self.debounce, deadline) - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            if self.expired:
+                while not self.zk.connected:
+                    self.condition.wait(1.0)
+                self.expired = False
+                self.events = {}
+                return None
+
+            events, self.events = self.events, {}
+            return events
+
+    def handle(self, events):
+        for path, types in events.items():
+            parts = self.parse(path)
+            if parts is None:
+                continue
+            if len(parts) in (GROUPS, TOPICS, SUBSCRIPTIONS):
+                if types & {EventType.CHILD, EventType.CREATED}:
+                    self.list(path)
+            elif EventType.DELETED in types:
+                # the parent's children watch takes care of removed nodes
+                continue
+            elif len(parts) == TOPIC:
+                self.fetch_topic(path, parts[0], parts[2])
+            elif len(parts) == SUBSCRIPTION:
+                self.fetch_subscription(path, parts[0], parts[2], parts[4])
+        self.pipeline.run()
+        self.writer.flush()
+        click.echo("Checked {} changed nodes".format(len(events)))
+
+    def list(self, path):
+        self.pipeline.get_children(path, self.on_children, watch=self.watch, missing=self.on_missing)
+
+    def on_missing(self, path):
+        # node listed by its parent, but not created yet: watch for its creation
+        self.pipeline.exists(path, lambda p, stat: self.list(p) if stat else None, watch=self.watch)
+
+    def on_children(self, path, children):
+        known = self.children.get(path, set())
+        current = set(children)
+        self.children[path] = current
+        for name in known - current:
+            self.forget("{}/{}".format(path, name))
+
+        parts = self.parse(path)
+        for name in sorted(current - known):
+            child = "{}/{}".format(path, name)
+            if len(parts) == GROUPS:
+                self.list("{}/topics".format(child))
+            elif len(parts) == TOPICS:
+                self.fetch_topic(child, parts[0], name)
+                if any(v.wants_subscriptions(parts[0], name) for v in self.visitors):
+                    self.list("{}/subscriptions".format(child))
+            elif len(parts) == SUBSCRIPTIONS:
+                self.fetch_subscription(child, parts[0], parts[2], name)
+
+    def forget(self, path):
+        for known in [p for p in self.children if p == path or p.startswith(path + '/')]:
+            del self.children[known]
+
+    def fetch_topic(self, path, group, topic):
+        visitors = [v for v in self.visitors if v.wants_topic(group, topic)]
+        if visitors:
+            self.pipeline.get(
+                path, lambda p, result: self.on_topic(p, group, topic, visitors, *result), watch=self.watch
+            )
+
+    def fetch_subscription(self, path, group, topic, subscription):
+        visitors = [
+            v for v in self.visitors
+            if v.wants_subscriptions(group, topic) and v.wants_subscription(group, topic, subscription)
+        ]
+        if visitors:
+            self.pipeline.get(
+                path, lambda p, result: self.on_subscription(p, group, topic, subscription, visitors, *result),
+                watch=self.watch
+            )
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+
+import click
+from kazoo.exceptions import BadVersionError, NoNodeError, RolledBackError, RuntimeInconsistency
+from kazoo.protocol.states import ZnodeStat
+
+
+class PendingWrite:
+    def __init__(self, path, data, version, fix, retries):
+        self.path = path
+        self.data = data
+        self.version = version
+        self.fixes = [fix]
+        self.retries = retries
+
+
+class BatchWriter:
+
+    """Groups node updates into version-checked ZooKeeper multi transactions.
+
+    Every update carries the version of the payload it was computed from, so a
+    node changed by someone else between our read and our write is rejected by
+    ZooKeeper instead of being overwritten. Rejected nodes are re-read, the
+    fixes are applied again to the fresh payload and the write is retried.
+    Committed writes are recorded in `journal`, when given.
+    """
+
+    def __init__(self, zk, batch_size=50, retries=3, journal=None):
+        self.zk = zk
+        self.batch_size = max(1, batch_size)
+        self.retries = retries
+        self.journal = journal
+        self.pending = OrderedDict()
+        self.waiting = []
+        self.given_up = []
+        self.written = 0
+        self.conflicts = 0
+        self.failed = 0
+
+    def update(self, path, data, version, fix):
+        """Queues a change of the node at `path`, read as `data` at `version`.
+
+        `fix` takes a node payload and returns the payload to write, or None when
+        no change is needed. It is applied again to a freshly read payload when
+        the node turns out to be modified concurrently.
+        """
+        write = self.pending.get(path)
+        try:
+            fixed = fix(write.data if write else data)
+        except ValueError:
+            self.give_up(path)
+            click.echo("Unable to read data of {}".format(path))
+            return
+        if fixed is None:
+            return
+
+        if write:
+            write.data = fixed
+            write.fixes.append(fix)
+        else:
+            self.pending[path] = PendingWrite(path, fixed, version, fix, self.retries)
+
+        if len(self.pending) >= self.batch_size:
+            self.commit_batch()
+
+    def flush(self):
+        while self.pending:
+            self.commit_batch()
+
+    def commit_batch(self):
+        batch = [self.pending.popitem(last=False)[1] for _ in range(min(self.batch_size, len(self.pending)))]
+
+        transaction = self.zk.transaction()
+        for write in batch:
+            transaction.set_data(write.path, write.data, write.version)
+
+        for write, result in zip(batch, transaction.commit()):
+            if isinstance(result, ZnodeStat):
+                self.written += 1
+                if self.journal:
+                    self.journal.written(write.path, result.version)
+            elif isinstance(result, (RolledBackError, RuntimeInconsistency)):
+                self.pending[write.path] = write
+            elif isinstance(result, BadVersionError):
+                self.conflicts += 1
+                self.reread(write)
+            elif isinstance(result, NoNodeError):
+                self.conflicts += 1
+                click.echo("Node removed before it could be written: {}".format(write.path))
+            else:
+                self.give_up(write.path)
+                click.echo("Unable to write {}: {!r}".format(write.path, result))
+        self.notify()
+
+    def give_up(self, path):
+        self.failed += 1
+        self.given_up.append(path)
+
+    def mark(self):
+        """Returns a mark for when_written(), to leave out updates given up on before it was taken."""
+        return len(self.given_up)
+
+    def when_written(self, callback, prefix='', since=0):
+        """Calls `callback` once every update queued so far has been committed, or given up on.
+
+        The callback is dropped when an update of a node under `prefix` has
+        been given up on since the `since` mark, as the work it stands for
+        isn't finished.
+        """
+        if self.pending:
+            self.waiting.append((set(self.pending), callback, prefix, since))
+        else:
+            self.settled(callback, prefix, since)
+
+    def notify(self):
+        waiting, self.waiting = self.waiting, []
+        for paths, callback, prefix, since in waiting:
+            if paths.isdisjoint(self.pending):
+                self.settled(callback, prefix, since)
+            else:
+                self.waiting.append((paths, callback, prefix, since))
+
+    def settled(self, callback, prefix, since):
+        if not any(path.startswith(prefix) for path in self.given_up[since:]):
+            callback()
+
+    def reread(self, write):
+        if write.retries <= 0:
+            self.give_up(write.path)
+            click.echo("Giving up on {}: modified concurrently too many times".format(write.path))
+            return
+
+        click.echo("Node modified concurrently, re-reading: {}".format(write.path))
+        try:
+            data, stat = self.zk.get(write.path)
+            changed = False
+            for fix in write.fixes:
+                fixed = fix(data)
+                if fixed is not None:
+                    data = fixed
+                    changed = True
+        except NoNodeError:
+            click.echo("Node removed before it could be written: {}".format(write.path))
+            return
+        except ValueError:
+            self.give_up(write.path)
+            click.echo("Unable to read data of {} after conflict".format(write.path))
+            return
+
+        if not changed:
+            click.echo("Node no longer needs changes: {}".format(write.path))
+            return
+
+        write.data = data
+        write.version = stat.version
+        write.retries -= 1
+        self.pending[write.path] = write
+
+    def counters(self):
+        return {'written': self.written, 'conflicts': self.conflicts, 'failed': self.failed}
+
+    def add_counters(self, counters):
+        self.written += counters['written']
+        self.conflicts += counters['conflicts']
+        self.failed += counters['failed']
+
+    def summary(self):
+        return "Written {} nodes, {} conflicts, {} failed".format(self.written, self.conflicts, self.failed)
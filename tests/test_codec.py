@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from hermes_tools import codec
+
+
+@pytest.fixture(params=['orjson', 'json'], autouse=True)
+def decoder(request, monkeypatch):
+    if request.param == 'orjson':
+        if codec.orjson is None:
+            pytest.skip("orjson is not installed")
+    else:
+        monkeypatch.setattr(codec, 'orjson', None)
+    return request.param
+
+
+def test_extract_returns_requested_keys_present():
+    data = b'{"state": "ACTIVE", "supportTeam": "x", "endpoint": "http://a"}'
+    assert codec.extract(data, ('state', 'owner')) == {'state': 'ACTIVE'}
+
+
+def test_extract_rejects_truncated_payload():
+    data = b'{"state":"ACTIVE","supportTeam":"x","endpoint":"http://a","headers":[{"n'
+    with pytest.raises(ValueError):
+        codec.extract(data, ('state',))
+
+
+def test_extract_takes_last_of_repeated_keys():
+    assert codec.extract(b'{"state":"SUSPENDED","state":"ACTIVE"}', ('state',)) == {'state': 'ACTIVE'}
+
+
+@pytest.mark.parametrize('data', [b'[]', b'"state"', b''])
+def test_extract_rejects_anything_but_an_object(data):
+    with pytest.raises(ValueError):
+        codec.extract(data, ('state',))
+
+
+def test_patch_replaces_value_keeping_other_bytes():
+    data = b'{"name": "a",  "owner": {"id": "x", "source": "s"}, "rest": [1,2]}'
+    patched = codec.patch(data, {'owner': {'id': "y", 'source': "s"}})
+    assert patched == b'{"name": "a",  "owner": {"id": "y", "source": "s"}, "rest": [1,2]}'
+
+
+def test_patch_appends_missing_key_in_document_spacing():
+    assert codec.patch(b'{"a":1}', {'b': [1, 2]}) == b'{"a":1,"b":[1,2]}'
+    assert codec.patch(b'{"a": 1}\n', {'b': [1, 2]}) == b'{"a": 1, "b": [1, 2]}\n'
+
+
+def test_patch_fills_empty_object():
+    assert codec.patch(b'{}', {'supportTeam': 'undefined'}) == b'{"supportTeam":"undefined"}'
+
+
+def test_patch_replaces_only_top_level_member():
+    # the nested member is written just like the top-level one, so it can't be replaced by searching for it
+    data = b'{"inner":{"state":"ACTIVE"},"state":"ACTIVE"}'
+    patched = codec.patch(data, {'state': 'SUSPENDED'})
+    assert patched == b'{"inner":{"state":"ACTIVE"},"state":"SUSPENDED"}'
+
+
+def test_patch_keeps_non_ascii_text():
+    data = '{"description": "zażółć", "owner": null}'.encode("utf-8")
+    patched = codec.patch(data, {'owner': {'id': "gęś"}})
+    assert json.loads(patched) == {'description': "zażółć", 'owner': {'id': "gęś"}}
+    assert patched.startswith('{"description": "zażółć", '.encode("utf-8"))
+
+
+@pytest.mark.parametrize('data', [b'{"a": 1', b'[1]', b'not json'])
+def test_patch_rejects_invalid_payload(data):
+    with pytest.raises(ValueError):
+        codec.patch(data, {'a': 2})